@@ -29,8 +29,11 @@ project_root = os.path.abspath(os.path.join(__file__, "..", "..", "..", ".."))
 if project_root not in sys.path:
     sys.path.append(project_root)
 
-from src.predict_next_month_TC import call_predict_next_month_total_consumption
-from src.billing import euros_per_m3, get_next_month_bill
+from src.predict_next_month_TC import QUANTILE_COLUMNS, call_predict_next_month_total_consumption
+from src.billing import bill_range, euros_per_m3, get_next_month_bill
+from src.model_store import get_shared_model_store
+from src.data_access import dataset_fingerprint, load_ici
+from src.prefix_index import PrefixIndex
 # -------------------------------
 # Load data
 # -------------------------------
@@ -38,12 +41,16 @@ data_dir = os.path.join(project_root, "data")
 file_name = "clean_incidencies_comptadors_intelligents.parquet"
 data_path = os.path.join(data_dir, file_name)
 
-@st.cache_data
 def load_data():
-    return pd.read_parquet(data_path)
+    # view of the single process-wide copy shared by every page and session
+    return load_ici(["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"], path=data_path)
 
 df = load_data()
 
+def get_model_store():
+    #one store for every page and session of the process
+    return get_shared_model_store(os.path.join(project_root, "models"))
+
 # -------------------------------
 # Page Title
 # -------------------------------
@@ -64,7 +71,11 @@ st.markdown(
 
 st.divider()
 
-polizas=df["POLIZA_SUMINISTRO"].unique().tolist()
+@st.cache_resource
+def get_poliza_index(data_key):
+    return PrefixIndex(load_data()["POLIZA_SUMINISTRO"])
+
+poliza_index = get_poliza_index(dataset_fingerprint(data_path))
 
 
 
@@ -78,7 +89,12 @@ col1, col2 = st.columns([0.6, 0.4])
 
 
 with col1:
-    poliza = st.selectbox("Matching invoices",polizas)
+    user_input = st.text_input("Introduce your invoice:")
+    # binary search on the sorted pólisses, only the first matches are listed
+    poliza = st.selectbox("Matching invoices", poliza_index.search(user_input))
+    if user_input and poliza is None:
+        st.error("The invoice introduced does not exist in our dataset.")
+        st.stop()
 
 
 
@@ -90,13 +106,29 @@ with col2:
     )
     st.session_state['service_type'] = service_type
 
+col1, col2 = st.columns([0.6, 0.4])
+
+with col1:
+    horizon = st.select_slider("Forecast horizon (days)", options=[30, 60, 90], value=30)
+
+with col2:
+    #direct predicts every day of the horizon at once, recursive day by day
+    mode = st.radio("Forecast method", options=["recursive", "direct"], horizontal=True)
+
+#the bands need their own (cached) quantile model, only computed when asked for
+show_range = st.checkbox("Show the likely bill range (P10-P90)")
+
 if st.button("Run Prediction"):
     if poliza.strip() == "":
         st.error("Please enter a valid POLIZA_SUMINISTRO.")
     else:
         try:
-            total_pred, forecast_df, df_extended = call_predict_next_month_total_consumption(df, poliza)
+            total_pred, forecast_df, df_extended = call_predict_next_month_total_consumption(
+                df, poliza, forecast_days=horizon, model_store=get_model_store(), mode=mode, quantiles=show_range
+            )[:3]
             st.session_state['poliza'] = poliza
+            st.session_state['forecast_df'] = forecast_df
+            st.session_state['forecast_days'] = horizon
             st.session_state['df_extended'] = df_extended
             st.session_state['total_pred'] = total_pred
             st.session_state['service_type'] = service_type
@@ -118,7 +150,7 @@ if 'df_extended' in st.session_state:
 
     if not last_year_data.empty:
         avg_daily_last_year = last_year_data["CONSUMO_REAL"].mean()
-        forecast_days = 30
+        forecast_days = st.session_state['forecast_days']
         expected_avg = avg_daily_last_year * forecast_days
         pct_change = ((total_pred - expected_avg) / expected_avg) * 100
 
@@ -132,10 +164,17 @@ if 'df_extended' in st.session_state:
         total_pred = st.session_state['total_pred']
         service_type = st.session_state['service_type']
 
-        base_price = euros_per_m3(total_pred, service_type)
+        #tariff tiers are monthly: the bill is for the first 30 forecast days
+        month_pred = st.session_state['forecast_df']["CONSUMO_REAL"].head(30).sum()
+        base_price = euros_per_m3(month_pred, service_type)
         estimated_bill = get_next_month_bill(base_price)
 
-        col3.metric("💳 Estimated Bill", f"€{estimated_bill:.2f}")
+        col3.metric("💳 Estimated Bill (next month)", f"€{estimated_bill:.2f}")
+        #P10-P90 consumption of the next month mapped to euros
+        if set(QUANTILE_COLUMNS).issubset(st.session_state['forecast_df'].columns):
+            month_bands = st.session_state['forecast_df'][QUANTILE_COLUMNS].head(30).sum()
+            bill_bands = bill_range(month_bands, service_type)
+            col3.caption(f"Likely range (P10-P90): €{bill_bands['P10']:.2f} - €{bill_bands['P90']:.2f}")
         efficiency_msg = "✅ Efficient" if total_pred <= expected_avg else "⚠️ Above Average"
         col4.metric("⚡ Efficiency", efficiency_msg)
 
@@ -16,6 +16,10 @@ if project_root not in sys.path:
     sys.path.append(project_root)
                     
 from src.predict_next_month_TC import call_predict_next_month_total_consumption
+from src.model_store import get_shared_model_store
+from src.anomalies import ThresholdIndex, band_zscores, fleet_threshold_index
+from src.data_access import dataset_fingerprint, load_ici
+from src.prefix_index import PrefixIndex
 
 st.set_page_config(page_title="Detection of anomalies",page_icon="🚨", layout="wide", initial_sidebar_state="expanded")
 
@@ -53,22 +57,25 @@ st.divider()
 st.sidebar.header("⚙️ Configuration")
 data_source=st.sidebar.radio("Data",["Default file", "Load parquet file"],index=0)
 
-@st.cache_data
 def load_default_parquet():
     file ="clean_incidencies_comptadors_intelligents.parquet"
     base_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../../"))
     data_dir =os.path.join(base_dir, "data")
     sample_path=os.path.join(data_dir,file)
-    df_ICI=pd.read_parquet(sample_path)
-    return df_ICI
+    # view of the single process-wide copy shared by every page and session
+    df_ICI=load_ici(["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"], path=sample_path)
+    return df_ICI, dataset_fingerprint(sample_path)
 
 
+#data_key identifies the data (file fingerprint / upload id) so the caches
+#below never have to hash the whole DataFrame
 if data_source=="Default file":
-    df=load_default_parquet()
+    df, data_key=load_default_parquet()
 else:
     uploaded=st.sidebar.file_uploader("Upload parquet", type=["parquet"])
     if uploaded:
         df=pd.read_parquet(uploaded)
+        data_key=("upload", uploaded.name, uploaded.size, getattr(uploaded, "file_id", None))
     else:
         st.stop()
 
@@ -76,13 +83,15 @@ else:
 # -------------------------------
 # Invoice input
 # -------------------------------
-polizas=df["POLIZA_SUMINISTRO"].unique().tolist()
+@st.cache_resource
+def get_poliza_index(_df,data_key):
+    return PrefixIndex(_df["POLIZA_SUMINISTRO"])
+
+poliza_index=get_poliza_index(df,data_key)
 user_input=st.sidebar.text_input("Introduce your invoice:")
 
-if user_input:
-    filtered_poliza=[p for p in polizas if p.startswith(user_input)]
-else:
-    filtered_poliza=polizas
+#binary search on the sorted pólisses, only the first matches are listed
+filtered_poliza=poliza_index.search(user_input)
 
 if user_input and len(filtered_poliza)==0:
     st.sidebar.error("The invoice introduced does not exist in our dataset."
@@ -91,6 +100,8 @@ if user_input and len(filtered_poliza)==0:
 
 poliza_id= st.sidebar.selectbox("Matching invoices",filtered_poliza)
 threshold=st.sidebar.slider("Anomaly threshold", 1.0,5.0,2.0,0.1)
+#the bands need their own (cached) quantile model, only computed when asked for
+use_bands=st.sidebar.checkbox("Forecast bands (P10-P90)")
 
 # -------------------------------
 # Sidebar explanations
@@ -106,6 +117,8 @@ with st.sidebar.expander("📘 What is the forecast_z_score?"):
         Where:
         - **Rolling Mean** = average of your last 7 days of consumption  
         - **Rolling Std** = typical day-to-day variation  
+        - With **Forecast bands** on, the Rolling std is replaced by the expected variation
+          of that day, from its P10-P90 forecast band  
 
         ### How to interpret it:
         - |score| > threshold → **Anomaly**  
@@ -158,40 +171,59 @@ with st.sidebar.expander("💰 How can you use forecast anomalies to save money?
 # -------------------------------
 # Forecast & anomaly detection
 # -------------------------------
+def get_model_store():
+    #one store for every page and session of the process
+    return get_shared_model_store(os.path.join(project_root, "models"))
+
 @st.cache_data(show_spinner=True)
-def cached_forecast(df,poliza_id):
-    total,forecast_df, df_extended=call_predict_next_month_total_consumption(df, poliza_id)
+def cached_forecast(_df,data_key,poliza_id,quantiles):
+    #quantiles adds the P10/P50/P90 band of every forecast day
+    total,forecast_df, df_extended=call_predict_next_month_total_consumption(
+        _df, poliza_id, model_store=get_model_store(), quantiles=quantiles)[:3]
     df_extended["is_forecast"] = False
     forecast_df["is_forecast"] = True
     return total, forecast_df, df_extended
 
 @st.cache_data
-def compute_base(df,poliza_id):
-    total,forecast_df,df_extended= cached_forecast(df,poliza_id)
-    df_analysis=df_extended.copy()
+def compute_base(_df,data_key,poliza_id,quantiles):
+    total,forecast_df,df_extended= cached_forecast(_df,data_key,poliza_id,quantiles)
+    df_analysis=df_extended.reset_index(drop=True)
     df_analysis["rolling_mean"]=df_analysis["CONSUMO_REAL"].rolling(window=7,min_periods=3).mean()
     df_analysis["rolling_std"]=df_analysis["CONSUMO_REAL"].rolling(window=7,min_periods=3).std()
-    return df_analysis,forecast_df
+    df_analysis["z_score"]=(df_analysis["CONSUMO_REAL"]-df_analysis["rolling_mean"])/df_analysis["rolling_std"]
 
-df_analysis,df_forecast=compute_base(df,poliza_id)
+    #same with forecasted data, against the spread of its own quantile band if there is one
+    df_forecasting=forecast_df.merge(df_analysis[["FECHA","rolling_mean","rolling_std"]],on="FECHA",how="left")
+    if quantiles:
+        df_forecasting["forecast_z_score"]=band_zscores(df_forecasting["CONSUMO_REAL"],df_forecasting["rolling_mean"],
+                                                        df_forecasting["P10"],df_forecasting["P90"])
+    else:
+        df_forecasting["forecast_z_score"]=((df_forecasting["CONSUMO_REAL"]-df_forecasting["rolling_mean"])/df_forecasting["rolling_std"])
+    df_forecasting=df_forecasting[df_forecasting["is_forecast"]].reset_index(drop=True)
 
+    #z-scores are computed once, the threshold only queries these sorted indexes
+    hist_index=ThresholdIndex(df_analysis["z_score"])
+    forecast_index=ThresholdIndex(df_forecasting["forecast_z_score"])
+    return df_analysis,df_forecasting,hist_index,forecast_index
+
+df_analysis,df_forecasting,hist_index,forecast_index=compute_base(df,data_key,poliza_id,use_bands)
+
+
+def detect_anomalies(df_analysis,df_forecasting,hist_index,forecast_index,threshold):
+    anomalies=df_analysis.iloc[hist_index.select(threshold)].assign(is_anomaly=True)
+    anomalies_forecast=df_forecasting.iloc[forecast_index.select(threshold)].assign(forecast_is_anomaly=True)
+    return anomalies, anomalies_forecast
 
-def detect_anomalies(df_analysis,df_forecast,threshold):
-    df_analysis["z_score"]=(df_analysis["CONSUMO_REAL"]-df_analysis["rolling_mean"])/df_analysis["rolling_std"]
-    df_analysis["is_anomaly"]=df_analysis["z_score"].abs()>threshold
-    anomalies=df_analysis[df_analysis["is_anomaly"]]
-
-    #same with forecasted data
-    df_forecasting=df_forecast.copy()
-    df_forecasting=df_forecasting.merge(df_analysis[["FECHA","rolling_mean","rolling_std"]],on="FECHA",how="left")
-    df_forecasting["forecast_z_score"]=((df_forecasting["CONSUMO_REAL"]-df_forecasting["rolling_mean"])/df_forecasting["rolling_std"])
-    df_forecasting["forecast_is_anomaly"]=df_forecasting["forecast_z_score"].abs()>threshold
-    anomalies_forecast=df_forecasting[df_forecasting["forecast_is_anomaly"] & df_forecasting["is_forecast"]]
-    
-    return df_analysis, anomalies, df_forecasting, anomalies_forecast
 
+anomalies, anomalies_forecast=detect_anomalies(df_analysis,df_forecasting,hist_index,forecast_index,threshold)
 
-df_analysis,anomalies, df_forecasting, anomalies_forecast=detect_anomalies(df_analysis, df_forecast,threshold)
+@st.cache_resource(show_spinner=True)
+def get_fleet_threshold_index(_df,data_key):
+    return fleet_threshold_index(_df)
+
+fleet_index=get_fleet_threshold_index(df,data_key)
+st.sidebar.caption(f"All meters at this threshold: {fleet_index.count(threshold):,} anomalous readings "
+                   f"in {fleet_index.count_groups(threshold):,} meters")
 
 # -------------------------------
 # Results
@@ -211,6 +243,13 @@ with col2:
         <p style='font-size:2em; font-weight:bold; color:{TEXT_PRIMARY}; margin:5px 0;'>{len(anomalies_forecast)}</p></div>
     """, unsafe_allow_html=True)
 
+with st.expander("📉 Fleet-wide anomalies vs threshold"):
+    fleet_curve=fleet_index.curve()
+    fig_curve=px.line(fleet_curve,x="threshold",y=["n_anomalies","n_meters"],markers=True,
+                      labels={"value":"Count","threshold":"Anomaly threshold","variable":""})
+    fig_curve.add_vline(x=threshold,line_dash="dash",line_color=PRIMARY_DARK)
+    st.plotly_chart(fig_curve, use_container_width=True)
+
 st.divider()
 
 # -------------------------------
@@ -229,6 +268,14 @@ fig.add_trace(go.Scatter(x=hist["FECHA"], y=hist["CONSUMO_REAL"],
 fig.add_trace(go.Scatter(x=anomalies["FECHA"], y=anomalies["CONSUMO_REAL"],
                          mode="markers", name="Historical Anomaly", marker_color="red", marker_size=8))
 
+# Forecast band (P10-P90)
+if use_bands:
+    fig.add_trace(go.Scatter(x=df_forecasting["FECHA"], y=df_forecasting["P90"],
+                             mode="lines", line=dict(width=0), showlegend=False, hoverinfo="skip"))
+    fig.add_trace(go.Scatter(x=df_forecasting["FECHA"], y=df_forecasting["P10"],
+                             mode="lines", line=dict(width=0), fill="tonexty", fillcolor="rgba(168,213,232,0.35)",
+                             name="Forecast band (P10-P90)"))
+
 # Forecasted consumption
 fig.add_trace(go.Scatter(x=df_forecasting["FECHA"], y=df_forecasting["CONSUMO_REAL"],
                          mode="lines", name="Forecasted Consumption",
@@ -4,7 +4,6 @@ from pathlib import Path
 import plotly.express as px
 import seaborn as sns
 import matplotlib.pyplot as plt
-import numpy as np
 import sys
 import os
 import math
@@ -36,6 +35,9 @@ if project_root not in sys.path:
 
 from src.predict_next_month_TC import call_predict_next_month_total_consumption
 from src.billing import euros_per_m3, get_next_month_bill
+from src.census_rollups import DAILY_FILE, SectionRankingIndex, build_rollups, load_rollup
+from src.prefix_index import PrefixIndex
+from src.data_access import dataset_fingerprint
 # -------------------------------
 # Load data
 # -------------------------------
@@ -43,35 +45,25 @@ data_dir = os.path.join(project_root, "data")
 file_name = "clean_incidencies_comptadors_intelligents.parquet"
 data_path = os.path.join(data_dir, file_name)
 
+rollup_dir = os.path.join(data_dir, "rollups")
+rollup_path = os.path.join(rollup_dir, DAILY_FILE)
+
 @st.cache_data
-def load_data(date_filter=None):
-
-    # Columns we actually need
-    columns_to_load = ["FECHA", "SECCIO_CENSAL", "CONSUMO_REAL", "US_AIGUA_GEST"]
-    
-    # Load parquet with only these columns
-    df = pd.read_parquet(data_path, columns=columns_to_load)
-    
-    df["FECHA"] = pd.to_datetime(df["FECHA"])
-    if date_filter is not None:
-        start_date, end_date = date_filter
-        df = df[(df["FECHA"] >= start_date) & (df["FECHA"] <= end_date)]
-    
-
-    df["CONSUMO_REAL"] = pd.to_numeric(df["CONSUMO_REAL"], errors="coerce").astype("float32")
-    if "SECCIO_CENSAL" in df.columns:
-        df["SECCIO_CENSAL_STR"] = df["SECCIO_CENSAL"].apply(
-            lambda x: str(int(x)).zfill(10) if pd.notna(x) else None
-        ).astype("category")
-    else:
-        df["SECCIO_CENSAL_STR"] = None
-    
-    if "US_AIGUA_GEST" in df.columns:
-        df["US_AIGUA_GEST"] = df["US_AIGUA_GEST"].astype("category")
-    
-    return df
+def load_data(data_key):
+    # Daily consumption sums per section / use type, built once from the full
+    # ICI data (and rebuilt only when the data file is newer than the rollup).
+    # data_key is the data file's fingerprint, so a rewritten file is reloaded
+    if not os.path.exists(rollup_path) or os.path.getmtime(rollup_path) < os.path.getmtime(data_path):
+        build_rollups(data_path, rollup_dir)
+    return load_rollup(rollup_dir, "daily")
+
+data_key = dataset_fingerprint(data_path)
+df = load_data(data_key)
 
-df = load_data()
+@st.cache_resource
+def load_section_index(data_key):
+    # keyed like load_data so a rebuilt rollup gets a fresh index
+    return SectionRankingIndex(load_data(data_key))
 
 
 # -------------------------------
@@ -98,10 +90,14 @@ st.divider()
 # -------------------------------
 # User input
 # -------------------------------
-seccio_codes_str = sorted(df["SECCIO_CENSAL_STR"].dropna().unique().tolist()) if "SECCIO_CENSAL_STR" in df.columns else []
+@st.cache_resource
+def load_code_index(data_key):
+    return PrefixIndex(load_data(data_key)["SECCIO_CENSAL_STR"])
+
+code_index = load_code_index(data_key)
 
 user_input = st.sidebar.text_input("Enter SECCIO_CENSAL code:")
-filtered_codes = [p for p in seccio_codes_str if p.startswith(user_input)] if user_input else seccio_codes_str
+filtered_codes = code_index.search(user_input)
 
 if user_input and len(filtered_codes) == 0:
     st.sidebar.error("Code not found in dataset. Check typos or residence.")
@@ -209,32 +205,11 @@ st.divider()
 # Ranking
 # -------------------------------
 st.subheader("How your section ranks")
-row_mask = (df["FECHA"] >= start_date) & (df["FECHA"] <= end_date)
-df_filtered = df.loc[row_mask, ["FECHA", "SECCIO_CENSAL_STR", "CONSUMO_REAL"]]
-
-df_month = df_filtered 
-if not np.issubdtype(df_month["FECHA"].dtype, np.datetime64):
-    df_month["FECHA"] = pd.to_datetime(df_month["FECHA"])
-df_month["SECCIO_CENSAL_STR"] = df_month["SECCIO_CENSAL_STR"].astype("category")
-
-df_month["month"] = df_month["FECHA"].dt.to_period("M")
-monthly = (
-    df_month.groupby(["SECCIO_CENSAL_STR", "month"])["CONSUMO_REAL"]
-    .sum()
-    .reset_index()
-)
-ranking = (
-    monthly.groupby("SECCIO_CENSAL_STR")["CONSUMO_REAL"]
-    .mean()
-    .reset_index()
-    .rename(columns={"CONSUMO_REAL":"avg_monthly"})
-)
+section_index = load_section_index(data_key)
 
-# Your section mean
-my_section_avg = ranking.loc[ranking["SECCIO_CENSAL_STR"] == codi_censal, "avg_monthly"].values[0]
-peer_mean = ranking.loc[ranking["SECCIO_CENSAL_STR"] != codi_censal, "avg_monthly"].mean()
+# Your section mean vs the rest, from the prefix-sum index over monthly totals
+my_section_avg, peer_mean, percentile = section_index.rank(codi_censal, start_date, end_date)
 percent_diff = (my_section_avg - peer_mean) / peer_mean * 100
-percentile = (ranking["avg_monthly"] < my_section_avg).mean() * 100
 if percent_diff > 0:
     st.markdown(
         f"""<div style='background:#e3f2fd;padding:14px;border-radius:7px'>
@@ -0,0 +1,386 @@
+import numpy as np
+import pandas as pd
+
+# Same rolling window and default threshold as the anomaly detection page
+WINDOW = 7
+MIN_PERIODS = 3
+DEFAULT_THRESHOLD = 2.0
+# thresholds offered by the dashboard slider
+THRESHOLD_GRID = np.round(np.arange(1.0, 5.0 + 1e-9, 0.1), 1)
+# relative variance below which a window counts as constant (no z-score)
+VAR_EPS = 1e-12
+# P90 - P10 of a normal distribution, in standard deviations
+P10_P90_WIDTH = 2 * 1.2815515655446004
+
+
+def rolling_zscores(df, window=WINDOW, min_periods=MIN_PERIODS):
+    """
+    Rolling mean, std and z-score of CONSUMO_REAL for every POLIZA_SUMINISTRO
+    in one grouped pass, on the observed readings only (no forecast needed).
+
+    Args:
+        df (pandas.DataFrame): ICI data with POLIZA_SUMINISTRO, FECHA and CONSUMO_REAL.
+        window (int): Rolling window in readings (days).
+        min_periods (int): Minimum readings in the window to compute the statistics.
+
+    Returns:
+        pandas.DataFrame: Rows sorted by (POLIZA_SUMINISTRO, FECHA) with rolling_mean,
+            rolling_std and z_score columns (NaN until `min_periods` readings).
+    """
+    df_ = df[["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"]].copy()
+    df_["FECHA"] = pd.to_datetime(df_["FECHA"])
+    df_ = df_.sort_values(["POLIZA_SUMINISTRO", "FECHA"], kind="stable").reset_index(drop=True)
+
+    grouped = df_.groupby("POLIZA_SUMINISTRO", sort=False)["CONSUMO_REAL"]
+    rolling = grouped.rolling(window=window, min_periods=min_periods)
+    df_["rolling_mean"] = rolling.mean().reset_index(level=0, drop=True)
+    df_["rolling_std"] = rolling.std().reset_index(level=0, drop=True)
+    df_["z_score"] = (df_["CONSUMO_REAL"] - df_["rolling_mean"]) / df_["rolling_std"]
+    return df_
+
+
+def alert_table(df_scores, threshold=DEFAULT_THRESHOLD, lookback_days=7, as_of=None, top_n=None):
+    """
+    Ranked table of the meters with the strongest recent anomalies.
+
+    Every póliza with at least one |z_score| above `threshold` in the last
+    `lookback_days` days up to `as_of` gets one row with its strongest reading,
+    and the rows are sorted from the largest |z_score| down.
+
+    Args:
+        df_scores (pandas.DataFrame): Output of `rolling_zscores`.
+        threshold (float): |z_score| above which a reading is anomalous.
+        lookback_days (int): Days before `as_of` to look for anomalies in.
+        as_of (date-like, optional): End of the lookback, latest FECHA if None.
+        top_n (int, optional): Keep only the `top_n` strongest alerts.
+
+    Returns:
+        pandas.DataFrame: One row per alerted póliza with rank, FECHA, CONSUMO_REAL,
+            rolling_mean, z_score, direction ("high" / "low") and n_anomalies
+            (anomalous readings in the lookback).
+    """
+    as_of = pd.Timestamp(as_of) if as_of is not None else df_scores["FECHA"].max()
+    recent = df_scores[
+        (df_scores["FECHA"] > as_of - pd.Timedelta(days=lookback_days)) & (df_scores["FECHA"] <= as_of)
+    ]
+    recent = recent[recent["z_score"].abs() > threshold].assign(abs_z=lambda d: d["z_score"].abs())
+
+    columns = ["rank", "POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL", "rolling_mean", "z_score",
+               "direction", "n_anomalies"]
+    if recent.empty:
+        return pd.DataFrame(columns=columns)
+
+    n_anomalies = recent.groupby("POLIZA_SUMINISTRO", sort=False).size().rename("n_anomalies")
+    strongest = (
+        recent.sort_values("abs_z", ascending=False, kind="stable")
+        .drop_duplicates("POLIZA_SUMINISTRO")
+        .join(n_anomalies, on="POLIZA_SUMINISTRO")
+    )
+    if top_n is not None:
+        strongest = strongest.head(top_n)
+
+    strongest["direction"] = np.where(strongest["z_score"] > 0, "high", "low")
+    strongest["rank"] = np.arange(1, len(strongest) + 1)
+    return strongest[columns].reset_index(drop=True)
+
+
+class ThresholdIndex:
+    """
+    Sorted index of |z_score| to answer threshold queries without rescoring.
+
+    The z-scores are computed once; every query (`count`, `select`, `curve`)
+    is a binary search on the sorted absolute values. With `groups` (e.g. the
+    POLIZA_SUMINISTRO of every z-score), the sorted per-group maximum |z| also
+    gives the number of meters with at least one anomaly.
+
+    Args:
+        z_scores (array-like): z-scores, NaN never counts as an anomaly.
+        groups (array-like, optional): Group (meter) of every z-score.
+    """
+
+    def __init__(self, z_scores, groups=None):
+        abs_z = np.abs(np.asarray(z_scores, dtype=float))
+        valid = np.flatnonzero(~np.isnan(abs_z))
+        self._positions = valid[np.argsort(abs_z[valid], kind="stable")]
+        self._sorted = abs_z[self._positions]
+
+        self._group_max = None
+        if groups is not None:
+            group_max = pd.Series(abs_z).groupby(np.asarray(groups), sort=False).max().dropna()
+            self._group_max = np.sort(group_max.to_numpy())
+
+    def _first_above(self, sorted_values, threshold):
+        # anomalies are |z| strictly above the threshold, as in detect_anomalies
+        return np.searchsorted(sorted_values, threshold, side="right")
+
+    def count(self, threshold):
+        """
+        Number of z-scores with |z| above `threshold`.
+        """
+        return len(self._sorted) - self._first_above(self._sorted, threshold)
+
+    def count_groups(self, threshold):
+        """
+        Number of groups with at least one |z| above `threshold`.
+        """
+        return len(self._group_max) - self._first_above(self._group_max, threshold)
+
+    def select(self, threshold):
+        """
+        Positions (in the original order) of the z-scores with |z| above `threshold`.
+        """
+        return np.sort(self._positions[self._first_above(self._sorted, threshold):])
+
+    def curve(self, thresholds=THRESHOLD_GRID):
+        """
+        Anomaly count (and anomalous groups, if known) for every threshold.
+
+        Returns:
+            pandas.DataFrame: threshold, n_anomalies and n_meters columns.
+        """
+        thresholds = np.asarray(thresholds, dtype=float)
+        curve = pd.DataFrame({
+            "threshold": thresholds,
+            "n_anomalies": len(self._sorted) - self._first_above(self._sorted, thresholds),
+        })
+        if self._group_max is not None:
+            curve["n_meters"] = len(self._group_max) - self._first_above(self._group_max, thresholds)
+        return curve
+
+
+def fleet_threshold_index(df, window=WINDOW, min_periods=MIN_PERIODS):
+    """
+    ThresholdIndex over the rolling z-scores of every reading of every meter
+    in `df`, to tune the fleet-wide alert volume.
+    """
+    scores = rolling_zscores(df, window, min_periods)
+    return ThresholdIndex(scores["z_score"].to_numpy(), scores["POLIZA_SUMINISTRO"].to_numpy())
+
+
+def band_zscores(values, reference, p10, p90):
+    """
+    z-scores of forecasts against their own quantile bands: the deviation of
+    `values` from `reference` (e.g. the recent rolling mean) in units of the
+    spread implied by the P10-P90 band, instead of a rolling std.
+
+    Days with a zero-width band get NaN.
+    """
+    scale = (np.asarray(p90, dtype=float) - np.asarray(p10, dtype=float)) / P10_P90_WIDTH
+    z = (np.asarray(values, dtype=float) - np.asarray(reference, dtype=float)) / np.where(scale > 0, scale, np.nan)
+    if isinstance(values, pd.Series):
+        return pd.Series(z, index=values.index)
+    return z
+
+
+def scan_anomalies(df, threshold=DEFAULT_THRESHOLD, lookback_days=7, as_of=None, top_n=None,
+                   window=WINDOW, min_periods=MIN_PERIODS):
+    """
+    Scores every meter in `df` and returns the ranked alert table
+    (see `rolling_zscores` and `alert_table`).
+    """
+    return alert_table(rolling_zscores(df, window, min_periods), threshold, lookback_days, as_of, top_n)
+
+
+class StreamingAnomalyDetector:
+    """
+    Incremental version of the rolling z-score for near-real-time alerts.
+
+    Every meter keeps a small array-backed state: its last `window` readings
+    (ring buffer), how many of them are known and, optionally, an
+    exponentially weighted mean and variance. A new CONSUMO_REAL reading
+    updates that state and is scored like `rolling_zscores` scores it (sample
+    std over the last `window` readings, current one included, with at least
+    `min_periods` of them), so there is no history to recompute. The mean and
+    variance are recomputed from the buffered readings at every step, so no
+    rounding error is carried over from one reading to the next.
+
+    The state of all meters lives in a few numpy arrays (one row per meter)
+    and can be saved to / loaded from a .npz snapshot to survive restarts.
+
+    Args:
+        threshold (float): |z_score| above which a reading raises an alert.
+        window (int): Rolling window in readings.
+        min_periods (int): Minimum readings in the window to score.
+        ewm_alpha (float, optional): Smoothing factor of the EWMA mean / variance,
+            None to not keep them.
+    """
+
+    _STATE = ["buffer", "head", "n_valid", "ewm_mean", "ewm_var"]
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, window=WINDOW, min_periods=MIN_PERIODS, ewm_alpha=None,
+                 capacity=1024):
+        self.threshold = threshold
+        self.window = window
+        self.min_periods = min_periods
+        self.ewm_alpha = ewm_alpha
+        self.index = {}
+        self.poliza_ids = []
+        self._allocate(capacity)
+
+    def _allocate(self, capacity):
+        self.buffer = np.full((capacity, self.window), np.nan)
+        self.head = np.zeros(capacity, dtype=np.int64)
+        self.n_valid = np.zeros(capacity, dtype=np.int64)
+        self.ewm_mean = np.full(capacity, np.nan)
+        self.ewm_var = np.zeros(capacity)
+
+    def _grow(self, needed):
+        capacity = len(self.head)
+        if needed <= capacity:
+            return
+        new_capacity = max(needed, 2 * capacity)
+        old = {name: getattr(self, name) for name in self._STATE}
+        self._allocate(new_capacity)
+        for name, values in old.items():
+            getattr(self, name)[:capacity] = values
+
+    def _rows(self, poliza_ids):
+        rows = np.empty(len(poliza_ids), dtype=np.int64)
+        for i, poliza_id in enumerate(poliza_ids):
+            row = self.index.get(poliza_id)
+            if row is None:
+                row = len(self.poliza_ids)
+                self.index[poliza_id] = row
+                self.poliza_ids.append(poliza_id)
+            rows[i] = row
+        self._grow(len(self.poliza_ids))
+        return rows
+
+    def _step(self, rows, values):
+        # rows are unique here, so every meter is updated once
+        valid = ~np.isnan(values)
+        heads = self.head[rows]
+
+        # evict the oldest reading of the window, store the new one
+        evicted = self.buffer[rows, heads]
+        self.n_valid[rows] -= ~np.isnan(evicted)
+
+        self.buffer[rows, heads] = values
+        self.n_valid[rows] += valid
+        self.head[rows] = (heads + 1) % self.window
+
+        # two-pass mean / variance of the buffered readings
+        window = self.buffer[rows]
+        n = self.n_valid[rows]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = np.nansum(window, axis=1) / n
+            var = np.nansum((window - mean[:, None]) ** 2, axis=1) / (n - 1)
+            # a constant window has no spread to score against, as in pandas
+            var = np.where(var > VAR_EPS * np.maximum(mean ** 2, 1), var, np.nan)
+            z_score = (values - mean) / np.sqrt(var)
+        z_score = np.where(valid & (n >= self.min_periods), z_score, np.nan)
+
+        ewm_z = None
+        if self.ewm_alpha is not None:
+            ewm_z = self._ewm_step(rows, values, valid)
+        return z_score, ewm_z
+
+    def _ewm_step(self, rows, values, valid):
+        alpha = self.ewm_alpha
+        mean = self.ewm_mean[rows]
+        var = self.ewm_var[rows]
+        # scored against the state before the reading (its expected value)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ewm_z = np.where(valid & (var > 0), (values - mean) / np.sqrt(var), np.nan)
+
+        first = valid & np.isnan(mean)
+        diff = values - mean
+        new_mean = np.where(first, values, mean + alpha * diff)
+        new_var = np.where(first, 0.0, (1 - alpha) * (var + alpha * diff ** 2))
+        self.ewm_mean[rows] = np.where(valid, new_mean, mean)
+        self.ewm_var[rows] = np.where(valid, new_var, var)
+        return ewm_z
+
+    def update(self, poliza_id, value):
+        """
+        Adds one reading of `poliza_id` and scores it.
+
+        Returns:
+            tuple: (z_score, is_alert) of the reading.
+        """
+        z_score, _ = self._step(self._rows([poliza_id]), np.array([value], dtype=float))
+        return z_score[0], bool(np.abs(z_score[0]) > self.threshold)
+
+    def update_batch(self, poliza_ids, values, dates=None):
+        """
+        Adds many readings at once (e.g. the latest daily load) and returns the alerts.
+
+        Readings of the same póliza must be in chronological order; they are
+        applied in that order, every step updating all meters at once.
+
+        Args:
+            poliza_ids (array-like): POLIZA_SUMINISTRO of every reading.
+            values (array-like): CONSUMO_REAL of every reading.
+            dates (array-like, optional): FECHA of every reading, copied to the alerts.
+
+        Returns:
+            pandas.DataFrame: One row per reading with |z_score| above the threshold
+                (POLIZA_SUMINISTRO, FECHA, CONSUMO_REAL, z_score and ewm_z_score
+                when the EWMA is kept).
+        """
+        poliza_ids = np.asarray(poliza_ids, dtype=object)
+        values = np.asarray(values, dtype=float)
+        rows = self._rows(poliza_ids)
+
+        z_score = np.full(len(values), np.nan)
+        ewm_z = np.full(len(values), np.nan)
+        # k-th reading of every póliza is applied in step k
+        occurrence = pd.Series(rows).groupby(rows).cumcount().to_numpy()
+        # positions grouped by step once, in their original order within a step
+        order = np.argsort(occurrence, kind="stable")
+        bounds = np.cumsum(np.bincount(occurrence))[:-1] if len(rows) else []
+        for positions in np.split(order, bounds):
+            if not len(positions):
+                continue
+            step_z, step_ewm_z = self._step(rows[positions], values[positions])
+            z_score[positions] = step_z
+            if step_ewm_z is not None:
+                ewm_z[positions] = step_ewm_z
+
+        alerts = pd.DataFrame({
+            "POLIZA_SUMINISTRO": poliza_ids,
+            "FECHA": pd.to_datetime(dates) if dates is not None else pd.NaT,
+            "CONSUMO_REAL": values,
+            "z_score": z_score,
+        })
+        if self.ewm_alpha is not None:
+            alerts["ewm_z_score"] = ewm_z
+        return alerts[alerts["z_score"].abs() > self.threshold].reset_index(drop=True)
+
+    def warm_start(self, df):
+        """
+        Builds the state from historical readings (POLIZA_SUMINISTRO, FECHA,
+        CONSUMO_REAL) without returning alerts.
+        """
+        df_ = df.sort_values(["POLIZA_SUMINISTRO", "FECHA"], kind="stable")
+        self.update_batch(df_["POLIZA_SUMINISTRO"].to_numpy(), df_["CONSUMO_REAL"].to_numpy())
+        return self
+
+    def save(self, path):
+        """
+        Saves a snapshot of the state of every meter to a .npz file.
+        """
+        n = len(self.poliza_ids)
+        np.savez(
+            path,
+            poliza_ids=np.asarray(self.poliza_ids, dtype=str),
+            config=np.array([self.threshold, self.window, self.min_periods,
+                             np.nan if self.ewm_alpha is None else self.ewm_alpha]),
+            **{name: getattr(self, name)[:n] for name in self._STATE},
+        )
+
+    @classmethod
+    def load(cls, path):
+        """
+        Restores a detector saved with `save`.
+        """
+        with np.load(path) as snapshot:
+            threshold, window, min_periods, ewm_alpha = snapshot["config"]
+            poliza_ids = snapshot["poliza_ids"].tolist()
+            detector = cls(threshold, int(window), int(min_periods),
+                           None if np.isnan(ewm_alpha) else ewm_alpha, capacity=max(len(poliza_ids), 1))
+            for name in cls._STATE:
+                getattr(detector, name)[:len(poliza_ids)] = snapshot[name]
+        detector.poliza_ids = poliza_ids
+        detector.index = {poliza_id: row for row, poliza_id in enumerate(poliza_ids)}
+        return detector
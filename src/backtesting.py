@@ -0,0 +1,224 @@
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+import pandas as pd
+import xgboost as xgb
+
+from src.predict_next_month_TC import call_predict_next_month_total_consumption
+
+# Error sums kept per (póliza, cutoff) so metrics can be pooled exactly
+ERROR_SUMS = ["n_days", "sum_abs_error", "sum_sq_error", "sum_error", "sum_abs_pct_error", "n_nonzero"]
+
+
+def mae(y_true, y_pred):
+    #average difference between predicted and actual values
+    return np.mean(np.abs(np.asarray(y_pred) - np.asarray(y_true)))
+
+
+def rmse(y_true, y_pred):
+    #average magnitude of the errors between predicted and actual values
+    return np.sqrt(np.mean((np.asarray(y_pred) - np.asarray(y_true)) ** 2))
+
+
+def mape(y_true, y_pred):
+    #percentage error relative to actual values (zero consumptions are skipped)
+    y_true = np.asarray(y_true)
+    y_pred = np.asarray(y_pred)
+    mask = y_true != 0
+    if not np.any(mask):
+        return 0.0
+    return np.mean(np.abs((y_true[mask] - y_pred[mask]) / y_true[mask])) * 100
+
+
+def mean_bias_error(y_true, y_pred):
+    #average bias in predictions
+    return np.mean(np.asarray(y_pred) - np.asarray(y_true))
+
+
+def evaluation_metrics(y_true, y_pred):
+    """
+    MAE, RMSE, MAPE and MBE of a forecast, as in the model evaluation notebook.
+    """
+    return {
+        "MAE": mae(y_true, y_pred),
+        "RMSE": rmse(y_true, y_pred),
+        "MAPE": mape(y_true, y_pred),
+        "MBE": mean_bias_error(y_true, y_pred),
+    }
+
+
+def rolling_origins(last_date, n_origins=3, step_days=30, forecast_days=30):
+    """
+    Walk-forward cutoff dates: the latest one leaves `forecast_days` of data
+    to evaluate on, the previous ones are `step_days` apart.
+
+    Returns:
+        list: Cutoff dates, oldest first.
+    """
+    last_cutoff = pd.Timestamp(last_date) - pd.Timedelta(days=forecast_days)
+    return [last_cutoff - pd.Timedelta(days=step_days * k) for k in reversed(range(n_origins))]
+
+
+def _error_sums(y_true, y_pred):
+    error = y_pred - y_true
+    nonzero = y_true != 0
+    return {
+        "n_days": len(y_true),
+        "sum_abs_error": np.abs(error).sum(),
+        "sum_sq_error": (error ** 2).sum(),
+        "sum_error": error.sum(),
+        "sum_abs_pct_error": np.abs(error[nonzero] / y_true[nonzero]).sum(),
+        "n_nonzero": int(nonzero.sum()),
+    }
+
+
+def backtest_poliza(df_poliza, poliza_id, cutoffs, forecast_days=30, min_train_days=30):
+    """
+    Rolling-origin evaluation of one póliza: for every cutoff the model is
+    trained on the readings up to the cutoff and its forecast of the next
+    `forecast_days` days is compared with the actual readings, by date.
+
+    Cutoffs with fewer than `min_train_days` training readings or no actual
+    readings to compare with are skipped.
+
+    Returns:
+        list: One dict per evaluated cutoff with the error sums, the metrics and
+            the actual / predicted totals over the horizon.
+    """
+    df_poliza = df_poliza.assign(FECHA=pd.to_datetime(df_poliza["FECHA"]))
+    results = []
+    for cutoff in cutoffs:
+        cutoff = pd.Timestamp(cutoff)
+        train = df_poliza[df_poliza["FECHA"] <= cutoff]
+        test = df_poliza[
+            (df_poliza["FECHA"] > cutoff) & (df_poliza["FECHA"] <= cutoff + pd.Timedelta(days=forecast_days))
+        ].dropna(subset=["CONSUMO_REAL"])
+        if len(train) < min_train_days or test.empty:
+            continue
+
+        try:
+            _, forecast_df, _ = call_predict_next_month_total_consumption(train, poliza_id, forecast_days)
+        except ValueError:
+            # not enough history left after the lag features
+            continue
+        compared = test[["FECHA", "CONSUMO_REAL"]].merge(
+            forecast_df[["FECHA", "CONSUMO_REAL"]], on="FECHA", suffixes=("_true", "_pred")
+        )
+        if compared.empty:
+            continue
+
+        y_true = compared["CONSUMO_REAL_true"].to_numpy(dtype=float)
+        y_pred = compared["CONSUMO_REAL_pred"].to_numpy(dtype=float)
+        results.append({
+            "POLIZA_SUMINISTRO": poliza_id,
+            "cutoff": cutoff,
+            **_error_sums(y_true, y_pred),
+            **evaluation_metrics(y_true, y_pred),
+            "total_true": y_true.sum(),
+            "total_pred": y_pred.sum(),
+        })
+    return results
+
+
+def _backtest_chunk(df_chunk, cutoffs, forecast_days, min_train_days):
+    results = []
+    for poliza_id, df_poliza in df_chunk.groupby("POLIZA_SUMINISTRO", sort=False):
+        results.extend(backtest_poliza(df_poliza, poliza_id, cutoffs, forecast_days, min_train_days))
+    return results
+
+
+def _init_worker(threads_per_worker):
+    # the workers already run in parallel, XGBoost must not oversubscribe the cores
+    xgb.set_config(nthread=threads_per_worker)
+
+
+def run_backtest(df, cutoffs=None, forecast_days=30, n_origins=3, step_days=30, min_train_days=30,
+                 max_workers=None, polizas_per_task=50, threads_per_worker=1):
+    """
+    Walk-forward backtest of the next-month forecaster over many pólisses.
+
+    The data is split by póliza with one groupby and the pólisses are sent in
+    tasks of `polizas_per_task` to a process pool. Only about two tasks per
+    worker are in flight at a time, so memory stays bounded by those chunks
+    instead of growing with the number of pólisses.
+
+    Args:
+        df (pandas.DataFrame): ICI data with POLIZA_SUMINISTRO, FECHA and CONSUMO_REAL.
+        cutoffs (list, optional): Cutoff dates, from `rolling_origins` on the latest
+            FECHA if None.
+        forecast_days (int): Forecast horizon evaluated after every cutoff.
+        n_origins, step_days (int): Number and spacing of the default cutoffs.
+        min_train_days (int): Minimum training readings to evaluate a cutoff.
+        max_workers (int, optional): Worker processes, os.cpu_count() if None;
+            0 runs everything in the current process.
+        polizas_per_task (int): Pólisses evaluated per task.
+        threads_per_worker (int): XGBoost threads in every worker.
+
+    Returns:
+        pandas.DataFrame: One row per (POLIZA_SUMINISTRO, cutoff) with the error sums,
+            MAE, RMSE, MAPE, MBE and the actual / predicted totals.
+    """
+    df_ = df[["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"]].copy()
+    df_["FECHA"] = pd.to_datetime(df_["FECHA"])
+    if cutoffs is None:
+        cutoffs = rolling_origins(df_["FECHA"].max(), n_origins, step_days, forecast_days)
+
+    groups = list(df_.groupby("POLIZA_SUMINISTRO", sort=False).indices.values())
+    tasks = (
+        df_.iloc[np.concatenate(groups[i:i + polizas_per_task])]
+        for i in range(0, len(groups), polizas_per_task)
+    )
+
+    results = []
+    max_workers = os.cpu_count() if max_workers is None else max_workers
+    if max_workers == 0:
+        for chunk in tasks:
+            results.extend(_backtest_chunk(chunk, cutoffs, forecast_days, min_train_days))
+    else:
+        with ProcessPoolExecutor(max_workers, initializer=_init_worker, initargs=(threads_per_worker,)) as pool:
+            pending = set()
+            for chunk in tasks:
+                pending.add(pool.submit(_backtest_chunk, chunk, cutoffs, forecast_days, min_train_days))
+                if len(pending) >= 2 * max_workers:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        results.extend(future.result())
+            for future in pending:
+                results.extend(future.result())
+
+    columns = ["POLIZA_SUMINISTRO", "cutoff"] + ERROR_SUMS + ["MAE", "RMSE", "MAPE", "MBE", "total_true",
+                                                              "total_pred"]
+    return pd.DataFrame(results, columns=columns)
+
+
+def backtest_report(results, by="cutoff"):
+    """
+    Aggregates backtest results into one report table.
+
+    MAE, RMSE, MAPE and MBE are pooled over all the evaluated days of each
+    group (computed from the error sums, not averaged per póliza), and the
+    total error is the relative error of the summed horizon totals.
+
+    Args:
+        results (pandas.DataFrame): Output of `run_backtest`.
+        by (str or list, optional): Grouping column(s), None for a single overall row.
+
+    Returns:
+        pandas.DataFrame: One row per group with n_polizas, n_days, MAE, RMSE, MAPE,
+            MBE and TOTAL_ERROR_PCT.
+    """
+    keys = [] if by is None else ([by] if isinstance(by, str) else list(by))
+    grouped = results.assign(_all="all").groupby(keys or ["_all"], sort=True)
+
+    sums = grouped[ERROR_SUMS + ["total_true", "total_pred"]].sum()
+    report = pd.DataFrame({
+        "n_polizas": grouped["POLIZA_SUMINISTRO"].nunique(),
+        "n_days": sums["n_days"],
+        "MAE": sums["sum_abs_error"] / sums["n_days"],
+        "RMSE": np.sqrt(sums["sum_sq_error"] / sums["n_days"]),
+        "MAPE": (sums["sum_abs_pct_error"] / sums["n_nonzero"].where(sums["n_nonzero"] > 0)).fillna(0.0) * 100,
+        "MBE": sums["sum_error"] / sums["n_days"],
+        "TOTAL_ERROR_PCT": (sums["total_pred"] - sums["total_true"]) / sums["total_true"] * 100,
+    })
+    return report.reset_index(drop=not keys)
@@ -1,52 +1,196 @@
+import functools
+import json
+import os
+
+import numpy as np
 import pandas as pd
 from xgboost import XGBRegressor
 
-def euros_per_m3(liters, service_type):
+# Versioned tariff file. Every version has an effective date range, the
+# consumption bands per service type (the whole volume is priced at the rate
+# of the band it falls in; `bounds` are the inclusive upper m3 limits of every
+# band but the last and volumes below `min_m3` are not billed, null = no lower
+# limit), the VAT rate and the fixed surcharges added after VAT, in order.
+DEFAULT_TARIFFS_PATH = os.path.join(os.path.dirname(__file__), "tariffs.json")
+
+
+@functools.lru_cache(maxsize=8)
+def _compile_tariffs(path, mtime):
+    with open(path) as f:
+        raw = json.load(f)
+
+    versions = []
+    for version in sorted(raw["versions"], key=lambda v: v["valid_from"]):
+        versions.append({
+            "version": version["version"],
+            "valid_from": pd.Timestamp(version["valid_from"]),
+            "valid_to": pd.Timestamp(version["valid_to"]) if version["valid_to"] else None,
+            "bands": {
+                service_type: {
+                    "bounds": np.asarray(band["bounds"], dtype=float),
+                    "rates": np.asarray(band["rates"], dtype=float),
+                    "min_m3": band["min_m3"],
+                }
+                for service_type, band in version["bands"].items()
+            },
+            "vat_rate": version["vat_rate"],
+            "surcharges": [surcharge["amount"] for surcharge in version["surcharges"]],
+        })
+
+    starts = np.array([v["valid_from"].to_datetime64() for v in versions], dtype="datetime64[ns]")
+    return starts, versions
+
+
+def load_tariffs(tariffs_path=None):
+    """
+    Loads the tariff file compiled into band-boundary arrays.
+
+    The file is only parsed again when its modification time changes.
+
+    Returns:
+        tuple: (starts, versions) with the sorted valid_from dates and the compiled versions.
+    """
+    tariffs_path = tariffs_path or DEFAULT_TARIFFS_PATH
+    return _compile_tariffs(tariffs_path, os.path.getmtime(tariffs_path))
+
+
+def _version_indices(dates, starts, versions):
+    dates = pd.DatetimeIndex(np.atleast_1d(pd.to_datetime(dates))).to_numpy(dtype="datetime64[ns]")
+    indices = np.searchsorted(starts, dates, side="right") - 1
+
+    valid_to = np.array(
+        [v["valid_to"].to_datetime64() if v["valid_to"] is not None else np.datetime64("NaT") for v in versions],
+        dtype="datetime64[ns]",
+    )
+    ends = valid_to[np.clip(indices, 0, None)]
+    out_of_range = (indices < 0) | (~np.isnat(ends) & (dates > ends))
+    if out_of_range.any():
+        raise ValueError(f"No tariff in force on {pd.Timestamp(dates[out_of_range][0]).date()}")
+    return indices
+
+
+def get_tariff(date=None, tariffs_path=None):
+    """
+    Returns the compiled tariff version in force on `date` (today if None).
+    """
+    starts, versions = load_tariffs(tariffs_path)
+    if date is None:
+        date = pd.Timestamp.today().normalize()
+    return versions[_version_indices(date, starts, versions)[0]]
+
+
+def euros_per_m3(liters, service_type, date=None, tariffs_path=None):
     m3 = liters/1000
     price = 0
-    if service_type == "D": 
-        if 0 <= m3 <= 6: price = m3*0.8
-        elif 6 < m3 <= 9: price = m3 * 1.6002
-        elif 9 < m3 <= 15: price = m3 * 2.4894
-        elif 15 < m3 <= 18: price = m3 * 3.3189
-        elif 18 < m3: price= m3 * 4.1486
-
-    elif service_type == "C":
-        if 0 <= m3 <= 9: price = m3 * 1.2164
-        elif m3 >= 9: price = m3 * 2.4328
-
-    elif service_type == "A":       #mirar que es exactamente 
-        price = m3 * 1.1173 
+    band = get_tariff(date, tariffs_path)["bands"].get(service_type)
+    if band is not None:
+        rate = band["rates"][np.searchsorted(band["bounds"], m3, side="left")]
+        if band["min_m3"] is None or m3 >= band["min_m3"]:
+            price = m3 * rate
     return price
 
 
-def get_next_month_bill(price):
+def get_next_month_bill(price, date=None, tariffs_path=None):
     '''
-    price is the water consumption price computed. 
-    This function calculates the total amount of the next month bill. 
+    price is the water consumption price computed.
+    This function calculates the total amount of the next month bill
+    with the VAT and surcharges of the tariff in force on `date`.
     '''
-    #include IVA (10%)
-    price = price * 1.1
-
-    #canon aigua 
-    price += 6.91
-
-    #clavegueram 
-    price += 3.09
-
-    #tractament de residus
-    price += 11.43
-
-    #recollida de residus 
-    price += 10.19
-
-    return price 
-
+    return _add_surcharges(price, get_tariff(date, tariffs_path))
 
 
+def _add_surcharges(price, tariff):
+    #include IVA
+    price = price * (1 + tariff["vat_rate"])
 
+    #canon aigua, clavegueram, tractament and recollida de residus
+    for amount in tariff["surcharges"]:
+        price += amount
 
+    return price
 
 
+def _price_bands(m3, service_types, tariff):
+    price = np.zeros_like(m3)
+    for service_type, band in tariff["bands"].items():
+        mask = service_types == service_type
+        if not mask.any():
+            continue
+        m3_service = m3[mask]
+        # side="left" keeps band limits inclusive, NaN falls in the last band
+        service_price = m3_service * band["rates"][np.searchsorted(band["bounds"], m3_service, side="left")]
+        if band["min_m3"] is not None:
+            service_price = np.where(m3_service >= band["min_m3"], service_price, 0)
+        price[mask] = service_price
+    return price
 
 
+def _per_version(liters, service_types, billing_dates, tariffs_path, price_fn):
+    starts, versions = load_tariffs(tariffs_path)
+    m3 = np.asarray(liters, dtype=float) / 1000
+    service_types = np.broadcast_to(np.asarray(service_types), m3.shape)
+
+    if billing_dates is None:
+        # the version in force today, not one that only starts in the future
+        today = pd.Timestamp.today().normalize()
+        result = price_fn(m3, service_types, versions[_version_indices(today, starts, versions)[0]])
+    else:
+        indices = np.broadcast_to(_version_indices(billing_dates, starts, versions), m3.shape)
+        result = np.zeros_like(m3)
+        for index in np.unique(indices):
+            mask = indices == index
+            result[mask] = price_fn(m3[mask], service_types[mask], versions[index])
+
+    if isinstance(liters, pd.Series):
+        return pd.Series(result, index=liters.index, name=liters.name)
+    return result
+
+
+def euros_per_m3_array(liters, service_types, billing_dates=None, tariffs_path=None):
+    """
+    Vectorized version of euros_per_m3 for many contracts at once.
+
+    Args:
+        liters (array-like or pandas.Series): Consumption in liters.
+        service_types (array-like, pandas.Series or str): Service type ("D", "C", "A")
+            of every contract, or a single one for all of them.
+        billing_dates (array-like, optional): Billing period date of every contract, used
+            to pick the tariff version in force. The version in force today is used if None.
+        tariffs_path (str, optional): Tariff file, defaults to DEFAULT_TARIFFS_PATH.
+
+    Returns:
+        numpy.ndarray or pandas.Series: Consumption price per contract (a Series with
+            the same index when `liters` is a Series). Identical to euros_per_m3.
+    """
+    return _per_version(liters, service_types, billing_dates, tariffs_path, _price_bands)
+
+
+def compute_bills(liters, service_types, billing_dates=None, tariffs_path=None):
+    """
+    Total next month bill (consumption price + VAT + surcharges) for many contracts
+    at once, each billed with the tariff version in force on its billing date.
+    Identical to get_next_month_bill(euros_per_m3(...)).
+    """
+    def bill(m3, service_types, tariff):
+        return _add_surcharges(_price_bands(m3, service_types, tariff), tariff)
+
+    return _per_version(liters, service_types, billing_dates, tariffs_path, bill)
+
+
+def bill_range(liters_bands, service_type, billing_date=None, tariffs_path=None):
+    """
+    Maps consumption bands (e.g. the P10 / P50 / P90 forecast totals) to the
+    bills they would produce. Bills grow with consumption, so the bills keep
+    the order of the bands.
+
+    Args:
+        liters_bands (pandas.Series or array-like): Consumption in liters of every band.
+        service_type (str): Service type ("D", "C", "A").
+        billing_date (optional): Date picking the tariff version in force, today if None.
+        tariffs_path (str, optional): Tariff file, defaults to DEFAULT_TARIFFS_PATH.
+
+    Returns:
+        pandas.Series or numpy.ndarray: Total bill of every band, indexed like `liters_bands`.
+    """
+    billing_dates = None if billing_date is None else np.repeat(pd.Timestamp(billing_date), len(liters_bands))
+    return compute_bills(liters_bands, service_type, billing_dates, tariffs_path)
@@ -0,0 +1,222 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from src.data_preprocessing import seccio_censal_to_str
+
+# Dimensions of the rollups: census section, use type, district and municipality
+ROLLUP_KEYS = ["SECCIO_CENSAL", "US_AIGUA_GEST", "NUM_DTE_MUNI", "NUM_MUN_SGAB"]
+MEASURES = ["CONSUMO_REAL", "N_READINGS"]
+
+DAILY_FILE = "census_daily.parquet"
+MONTHLY_FILE = "census_monthly.parquet"
+
+
+def _rollup_keys(df):
+    return [c for c in ROLLUP_KEYS + ["SECCIO_CENSAL_STR"] if c in df.columns]
+
+
+def _with_section_str(rollup):
+    # readings cleaned before SECCIO_CENSAL_STR was stored at ingest: normalize
+    # the (much smaller) aggregated rows instead of every reading
+    if "SECCIO_CENSAL" in rollup.columns and "SECCIO_CENSAL_STR" not in rollup.columns:
+        rollup["SECCIO_CENSAL_STR"] = seccio_censal_to_str(rollup["SECCIO_CENSAL"])
+    return rollup
+
+
+def aggregate_daily(df):
+    """
+    Daily consumption sum and reading count per (FECHA, section, use type,
+    district, municipality) for a chunk of ICI readings.
+    """
+    keys = ["FECHA"] + _rollup_keys(df)
+    df = df.assign(FECHA=pd.to_datetime(df["FECHA"]).dt.normalize())
+    return _with_section_str(
+        df.groupby(keys, dropna=False, observed=True)["CONSUMO_REAL"]
+        .agg(CONSUMO_REAL="sum", N_READINGS="count")
+        .reset_index()
+    )
+
+
+def combine_rollups(*rollups):
+    """
+    Merges partial rollups with the same keys; sums and counts are additive.
+    """
+    rollup = pd.concat(rollups, ignore_index=True)
+    keys = [c for c in rollup.columns if c not in MEASURES]
+    return rollup.groupby(keys, dropna=False, observed=True)[MEASURES].sum().reset_index()
+
+
+def _finalize(daily):
+    daily = daily.sort_values("FECHA").reset_index(drop=True)
+    daily = _with_section_str(daily)
+    daily["SECCIO_CENSAL_STR"] = daily["SECCIO_CENSAL_STR"].astype("category")
+    if "US_AIGUA_GEST" in daily.columns:
+        daily["US_AIGUA_GEST"] = daily["US_AIGUA_GEST"].astype("category")
+    return daily
+
+
+def monthly_from_daily(daily):
+    """
+    Monthly rollup (month as the first day of the month) derived from the daily one.
+    """
+    monthly = daily.copy()
+    monthly["FECHA"] = monthly["FECHA"].dt.to_period("M").dt.to_timestamp()
+    return _finalize(combine_rollups(monthly))
+
+
+def _write(daily, rollup_dir):
+    os.makedirs(rollup_dir, exist_ok=True)
+    daily = _finalize(daily)
+    daily.to_parquet(os.path.join(rollup_dir, DAILY_FILE), index=False)
+    monthly_from_daily(daily).to_parquet(os.path.join(rollup_dir, MONTHLY_FILE), index=False)
+    return daily
+
+
+def build_rollups(source_path, rollup_dir, batch_size=1_000_000):
+    """
+    Builds the daily and monthly census rollups from the cleaned ICI parquet.
+
+    Only the rollup columns are read, batch by batch, and every batch is
+    reduced to its partial sums before being combined, so the full dataset is
+    never loaded at once.
+
+    Args:
+        source_path (str): Cleaned ICI .parquet file.
+        rollup_dir (str): Directory where census_daily / census_monthly are written.
+        batch_size (int): Rows read at a time.
+
+    Returns:
+        pandas.DataFrame: The daily rollup.
+    """
+    parquet_file = pq.ParquetFile(source_path)
+    available = set(parquet_file.schema_arrow.names)
+    columns = ["FECHA", "CONSUMO_REAL"] + [c for c in ROLLUP_KEYS + ["SECCIO_CENSAL_STR"] if c in available]
+
+    partials = [
+        aggregate_daily(batch.to_pandas())
+        for batch in parquet_file.iter_batches(batch_size=batch_size, columns=columns)
+    ]
+    return _write(combine_rollups(*partials), rollup_dir)
+
+
+def refresh_rollups(rollup_dir, new_readings):
+    """
+    Adds readings not yet included in the rollups (e.g. the latest daily load)
+    without rebuilding them from the full dataset.
+
+    Returns:
+        pandas.DataFrame: The updated daily rollup.
+    """
+    daily = load_rollup(rollup_dir, "daily")
+    return _write(combine_rollups(daily, aggregate_daily(new_readings)), rollup_dir)
+
+
+def load_rollup(rollup_dir, granularity="daily"):
+    """
+    Loads the "daily" or "monthly" census rollup.
+    """
+    file_name = DAILY_FILE if granularity == "daily" else MONTHLY_FILE
+    return pd.read_parquet(os.path.join(rollup_dir, file_name))
+
+
+class SectionRankingIndex:
+    """
+    Prefix-sum index over the daily census rollup for the section ranking.
+
+    Keeps, per section, the cumulative daily consumption and reading counts and
+    the cumulative number of months with readings. The average monthly
+    consumption of every section over any date range (total in range divided
+    by the months with readings in range, partial first / last months
+    included) is then an O(1) lookup per section, whatever the range length.
+
+    Args:
+        daily (pandas.DataFrame): Daily rollup from `build_rollups` / `load_rollup`.
+    """
+
+    def __init__(self, daily):
+        per_day = (
+            daily.dropna(subset=["SECCIO_CENSAL_STR"])
+            .groupby(["SECCIO_CENSAL_STR", "FECHA"], observed=True)[MEASURES]
+            .sum()
+            .reset_index()
+        )
+        self.sections = np.sort(per_day["SECCIO_CENSAL_STR"].astype(str).unique())
+        self.first_day = per_day["FECHA"].min()
+        days = pd.date_range(self.first_day, per_day["FECHA"].max(), freq="D")
+
+        rows = np.searchsorted(self.sections, per_day["SECCIO_CENSAL_STR"].astype(str))
+        cols = (per_day["FECHA"] - self.first_day).dt.days.to_numpy()
+        sums = np.zeros((len(self.sections), len(days)))
+        counts = np.zeros((len(self.sections), len(days)), dtype=np.int64)
+        sums[rows, cols] = per_day["CONSUMO_REAL"].to_numpy()
+        counts[rows, cols] = per_day["N_READINGS"].to_numpy()
+
+        self._sum_cum = np.concatenate([np.zeros((len(self.sections), 1)), sums.cumsum(axis=1)], axis=1)
+        self._count_cum = np.concatenate(
+            [np.zeros((len(self.sections), 1), dtype=np.int64), counts.cumsum(axis=1)], axis=1
+        )
+
+        # day positions where every month starts (+ the end of the axis)
+        month_starts = np.flatnonzero(np.r_[True, days.month[1:] != days.month[:-1]])
+        self._month_bounds = np.r_[month_starts, len(days)]
+        month_has_data = self._readings(self._month_bounds[:-1], self._month_bounds[1:]) > 0
+        self._month_cum = np.concatenate(
+            [np.zeros((len(self.sections), 1), dtype=np.int64), month_has_data.cumsum(axis=1)], axis=1
+        )
+
+    def _readings(self, start, end):
+        return self._count_cum[:, end] - self._count_cum[:, start]
+
+    def _position(self, date):
+        return int(np.clip((pd.Timestamp(date) - self.first_day).days, 0, self._month_bounds[-1]))
+
+    def average_monthly(self, start_date, end_date):
+        """
+        Average monthly consumption of every section between two dates (inclusive).
+
+        Returns:
+            pandas.Series: Average per SECCIO_CENSAL_STR, NaN for sections without
+                readings in the range.
+        """
+        start = self._position(start_date)
+        end = self._position(pd.Timestamp(end_date) + pd.Timedelta(days=1))
+        if end <= start:
+            return pd.Series(np.nan, index=self.sections)
+
+        total = self._sum_cum[:, end] - self._sum_cum[:, start]
+        first_month = np.searchsorted(self._month_bounds, start, side="right") - 1
+        last_month = np.searchsorted(self._month_bounds, end - 1, side="right") - 1
+
+        if first_month == last_month:
+            n_months = (self._readings(start, end) > 0).astype(np.int64)
+        else:
+            first_edge = self._readings(start, self._month_bounds[first_month + 1]) > 0
+            last_edge = self._readings(self._month_bounds[last_month], end) > 0
+            interior = self._month_cum[:, last_month] - self._month_cum[:, first_month + 1]
+            n_months = first_edge + interior + last_edge
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            average = np.where(n_months > 0, total / n_months, np.nan)
+        return pd.Series(average, index=self.sections)
+
+    def rank(self, section, start_date, end_date):
+        """
+        Ranks one section against all the others over a date range.
+
+        Returns:
+            tuple: (section average, mean of the other sections' averages,
+                percentage of sections with a lower average).
+        """
+        averages = self.average_monthly(start_date, end_date)
+        my_average = averages.get(section, np.nan)
+
+        valid = np.sort(averages.dropna().to_numpy())
+        if np.isnan(my_average) or len(valid) == 0:
+            return np.nan, np.nan, np.nan
+
+        peer_mean = (valid.sum() - my_average) / (len(valid) - 1) if len(valid) > 1 else np.nan
+        percentile = np.searchsorted(valid, my_average, side="left") / len(valid) * 100
+        return my_average, peer_mean, percentile
@@ -0,0 +1,168 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from src.data_preprocessing import seccio_censal_to_str
+
+DATASET_FILES = {
+    "CTA": "consum_total_agregat.parquet",
+    "RCA": "repte_consums_anomals.parquet",
+    "FEC": "fuites_experiencia_client.parquet",
+    "ICI": "incidencies_comptadors_intelligents.parquet",
+}
+
+ANOMALY_MAP = {32768: "CONTADOR_AVERIADO", 163840: "LECTURA_REPETIDA"}
+
+
+def is_date_column(col):
+    return "DATA" in col or "FECHA" in col or "DATE" in col
+
+
+def _output_schema(source_schema, dataset):
+    """
+    Schema of the cleaned output, fixed up front so every batch is written
+    with the same types (a batch where a column is all null would otherwise
+    infer a different type).
+    """
+    fields = []
+    for field in source_schema:
+        name = field.name.split('/')[0]
+        if is_date_column(name):
+            field_type = pa.timestamp("ns")
+        elif name == "CONSUMO_REAL":
+            field_type = pa.float64()
+        elif name == "CODI_ANOMALIA" and dataset == "RCA":
+            field_type = pa.string()
+        else:
+            field_type = field.type
+        fields.append(pa.field(name, field_type))
+    if dataset == "FEC":
+        fields.append(pa.field("DURATION_FACT_DAYS", pa.float64()))
+    if dataset == "ICI" and "SECCIO_CENSAL" in [f.name for f in fields]:
+        # normalized census code, dictionary-encoded (few distinct sections)
+        fields.append(pa.field("SECCIO_CENSAL_STR", pa.dictionary(pa.int32(), pa.string())))
+    return pa.schema(fields)
+
+
+def clean_batch(df, dataset, stats=None):
+    """
+    Applies the cleaning steps of the cleaning notebook to one chunk of a dataset.
+
+    Args:
+        df (pandas.DataFrame): Chunk with simplified column names.
+        dataset (str): "CTA", "RCA", "FEC" or "ICI".
+        stats (dict, optional): Counters of removed rows, updated in place.
+
+    Returns:
+        pandas.DataFrame: The cleaned chunk.
+    """
+    stats = stats if stats is not None else {}
+
+    #cleaning of duplicated elements
+    bef = len(df)
+    df = df.drop_duplicates()
+    stats["duplicates"] = stats.get("duplicates", 0) + bef - len(df)
+
+    #cleaning completly nan rows
+    bef = len(df)
+    df = df.dropna(how='all')
+    stats["nan_rows"] = stats.get("nan_rows", 0) + bef - len(df)
+
+    #replace none with nan and strip whitespaces (string values only)
+    for col in df.select_dtypes(include=["object", "string"]).columns:
+        values = df[col].replace("None", pd.NA)
+        if pd.api.types.infer_dtype(values, skipna=True) == "string":
+            df[col] = values.str.strip()
+        else:
+            df[col] = values.map(lambda x: x.strip() if isinstance(x, str) else x)
+
+    #modifies data type of the date columns
+    for col in [c for c in df.columns if is_date_column(c)]:
+        df[col] = pd.to_datetime(df[col], errors="coerce")
+
+    #negative consumptions are not valid
+    if "CONSUMO_REAL" in df.columns:
+        df["CONSUMO_REAL"] = pd.to_numeric(df["CONSUMO_REAL"], errors="coerce")
+        df.loc[df["CONSUMO_REAL"] < 0, "CONSUMO_REAL"] = np.nan
+
+    bef = len(df)
+    if dataset == "RCA":
+        if {"START_DATE", "END_DATE"}.issubset(df.columns):
+            df = df[df["START_DATE"] < df["END_DATE"]]
+        if "CODI_ANOMALIA" in df.columns:
+            codes = pd.to_numeric(df["CODI_ANOMALIA"], errors="coerce")
+            df["CODI_ANOMALIA"] = codes.map(ANOMALY_MAP).fillna(df["CODI_ANOMALIA"].astype(str))
+
+    elif dataset == "FEC":
+        if {"DATA_INI_FACT", "DATA_FIN_FACT"}.issubset(df.columns):
+            df = df[df["DATA_INI_FACT"] <= df["DATA_FIN_FACT"]].copy()
+            df["DURATION_FACT_DAYS"] = (df["DATA_FIN_FACT"] - df["DATA_INI_FACT"]).dt.days.astype(float)
+
+    elif dataset == "ICI":
+        if {"DATA_INST_COMP", "FECHA"}.issubset(df.columns):
+            df = df[df["DATA_INST_COMP"] <= df["FECHA"]]
+        #normalized census code computed once here so readers don't recompute it
+        if "SECCIO_CENSAL" in df.columns:
+            df = df.assign(SECCIO_CENSAL_STR=seccio_censal_to_str(df["SECCIO_CENSAL"]))
+    stats["invalid_rows"] = stats.get("invalid_rows", 0) + bef - len(df)
+
+    return df
+
+
+def clean_parquet_streaming(source_path, output_path, dataset, batch_size=500_000, verbose=True):
+    """
+    Cleans a full raw dataset in bounded memory.
+
+    The source file is read in batches with pq.ParquetFile, every batch goes
+    through `clean_batch` and is appended to the output file straight away, so
+    only one batch is in memory at a time. Duplicates are removed within each
+    batch; duplicated rows split across two batches are kept.
+
+    Args:
+        source_path (str): Raw .parquet file.
+        output_path (str): Cleaned .parquet file to write.
+        dataset (str): "CTA", "RCA", "FEC" or "ICI".
+        batch_size (int): Rows per batch.
+        verbose (bool): Print a summary of the removed rows.
+
+    Returns:
+        dict: Row counters (rows read, written and removed per step).
+    """
+    parquet_file = pq.ParquetFile(source_path)
+    schema = _output_schema(parquet_file.schema_arrow, dataset)
+    stats = {"rows_read": 0, "rows_written": 0}
+
+    with pq.ParquetWriter(output_path, schema) as writer:
+        for batch in parquet_file.iter_batches(batch_size=batch_size):
+            df = batch.to_pandas()
+            df.columns = [col.split('/')[0] for col in df.columns]
+            stats["rows_read"] += len(df)
+
+            df = clean_batch(df, dataset, stats)
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+            stats["rows_written"] += len(df)
+
+    if verbose:
+        print(f"{dataset}: {stats['rows_read']:,} rows read, {stats['rows_written']:,} rows written "
+              f"({stats.get('duplicates', 0):,} duplicated, {stats.get('nan_rows', 0):,} completely NaN, "
+              f"{stats.get('invalid_rows', 0):,} invalid) -> {output_path}")
+    return stats
+
+
+def clean_all_datasets(data_dir, batch_size=500_000, verbose=True):
+    """
+    Cleans the four raw datasets (CTA, RCA, FEC, ICI) found in `data_dir`,
+    writing them as clean_<file name> next to the raw files.
+    """
+    all_stats = {}
+    for dataset, file_name in DATASET_FILES.items():
+        source_path = os.path.join(data_dir, file_name)
+        if not os.path.exists(source_path):
+            print(f"The file doesn't exists in: {source_path}")
+            continue
+        output_path = os.path.join(data_dir, f"clean_{file_name}")
+        all_stats[dataset] = clean_parquet_streaming(source_path, output_path, dataset, batch_size, verbose)
+    return all_stats
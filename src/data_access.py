@@ -0,0 +1,113 @@
+import os
+import threading
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+DATA_DIR = os.path.join(PROJECT_ROOT, "data")
+ICI_PATH = os.path.join(DATA_DIR, "clean_incidencies_comptadors_intelligents.parquet")
+ARROW_CACHE_DIR = os.path.join(DATA_DIR, "cache")
+
+_lock = threading.Lock()
+# the current SharedDataset of every (path, cache_dir)
+_datasets = {}
+
+
+def dataset_fingerprint(path):
+    """
+    Cheap identity of a data file: (absolute path, modification time in ns, size).
+    Changes whenever the file is rewritten, without reading its contents.
+    """
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_mtime_ns, stat.st_size
+
+
+def arrow_cache_path(path, cache_dir=ARROW_CACHE_DIR):
+    return os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + ".arrow")
+
+
+def build_arrow_cache(path, cache_path):
+    """
+    Rewrites a parquet file as an uncompressed Arrow IPC file that can be
+    memory-mapped without decoding.
+
+    Every column is written as one contiguous chunk, so that pandas can use
+    the mapped buffers directly instead of concatenating chunks.
+    """
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    table = pq.read_table(path).combine_chunks()
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with pa.OSFile(tmp_path, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table, max_chunksize=max(table.num_rows, 1))
+    # atomic, so other processes never map a half-written file
+    os.replace(tmp_path, cache_path)
+
+
+def open_table(path, cache_dir=ARROW_CACHE_DIR):
+    """
+    Memory-mapped Arrow table of a parquet file.
+
+    The Arrow IPC copy is (re)built when missing or older than the parquet
+    file. The mapped table is backed by the OS page cache, so every process
+    reading it shares the same physical memory.
+    """
+    cache_path = arrow_cache_path(path, cache_dir)
+    if not os.path.exists(cache_path) or os.path.getmtime(cache_path) < os.path.getmtime(path):
+        build_arrow_cache(path, cache_path)
+    return pa.ipc.open_file(pa.memory_map(cache_path, "r")).read_all()
+
+
+class SharedDataset:
+    """
+    One in-memory copy of a dataset, shared by every caller in the process.
+
+    The data is memory-mapped from its Arrow IPC copy (see `open_table`) and
+    converted to pandas once, without copying the columns Arrow can hand over
+    as they are (numeric columns without nulls, strings). `frame` returns
+    column selections of that single DataFrame; with pandas copy-on-write
+    (the default from pandas 3) they are views until someone modifies them.
+
+    Args:
+        path (str): Parquet file.
+        cache_dir (str): Directory of the Arrow IPC copies.
+    """
+
+    def __init__(self, path, cache_dir=ARROW_CACHE_DIR):
+        self.path = path
+        self.fingerprint = dataset_fingerprint(path)
+        self.table = open_table(path, cache_dir)
+        self._df = self.table.to_pandas(split_blocks=True)
+
+    def frame(self, columns=None):
+        """
+        The dataset (or a column selection of it) as a pandas DataFrame view.
+        """
+        if columns is None:
+            return self._df[:]
+        return self._df[list(columns)]
+
+
+def get_shared_dataset(path=ICI_PATH, cache_dir=ARROW_CACHE_DIR):
+    """
+    Process-wide SharedDataset of `path`, loaded once and reused by every page
+    and session until the file changes.
+
+    Only the copy of the current file is kept: when the file is rewritten,
+    the previous copy is dropped before the new one is loaded.
+    """
+    key = (os.path.abspath(path), cache_dir)
+    fingerprint = dataset_fingerprint(path)
+    with _lock:
+        if key in _datasets and _datasets[key].fingerprint != fingerprint:
+            del _datasets[key]
+        if key not in _datasets:
+            _datasets[key] = SharedDataset(path, cache_dir)
+        return _datasets[key]
+
+
+def load_ici(columns=None, path=ICI_PATH):
+    """
+    Shared view of the cleaned ICI data (see `get_shared_dataset`).
+    """
+    return get_shared_dataset(path).frame(columns)
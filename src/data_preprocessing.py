@@ -2,32 +2,221 @@
 
 
 
+import functools
+import json
+import operator
+import os
+import shutil
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+N_POLIZA_BUCKETS = 64
+PARTITION_COLUMNS = ["poliza_bucket", "month"]
 
-def load_parquet_to_df(file_path):
+def load_parquet_to_df(file_path, columns=None, poliza_ids=None, start_date=None, end_date=None,
+                       verbose=False):
     """
     Reads a Parquet file from a specified path into a pandas DataFrame.
 
+    Column selections and póliza / date filters are given with the simplified
+    column names and pushed down to pyarrow on the original "/"-suffixed
+    names, so only the requested columns and matching row groups are read.
+
     Args:
         file_path (str): The path to the .parquet file.
+        columns (list, optional): Simplified names of the columns to read, all if None.
+        poliza_ids (str or list, optional): POLIZA_SUMINISTRO value(s) to keep.
+        start_date, end_date (date-like, optional): Inclusive FECHA range to keep.
+        verbose (bool): Print the simplified column names.
 
     Returns:
         pandas.DataFrame: The loaded DataFrame, or None if the file is not found.
     """
     try:
-        df = pd.read_parquet(file_path)
-        df = simplify_columns(df)
-        return df
+        dataset = ds.dataset(file_path, format="parquet")
     except FileNotFoundError:
         print(f"Error: The file was not found at {file_path}")
         return None
-    
-def simplify_columns(df):
+
+    original_names = {col.split('/')[0]: col for col in dataset.schema.names}
+    if columns is not None:
+        columns = [original_names[col] for col in columns]
+
+    expression = build_filter(dataset.schema, poliza_ids, start_date, end_date)
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    df = simplify_columns(df, verbose)
+    return df
+
+def simplify_columns(df, verbose=False):
     original_columns = df.columns.tolist()
     new_columns = [col.split('/')[0] for col in original_columns]
-    print(new_columns)
+    if verbose:
+        print(new_columns)
 
     df.columns = new_columns
 
     return df
-    
\ No newline at end of file
+
+
+def build_filter(schema, poliza_ids=None, start_date=None, end_date=None,
+                 poliza_column="POLIZA_SUMINISTRO", date_column="FECHA"):
+    """
+    Builds a pyarrow dataset filter for a póliza list and an inclusive date range.
+
+    Columns are looked up by their simplified name, so the filter applies to
+    both raw ("/"-suffixed) and simplified schemas. Dates stored as ISO strings
+    are compared as strings.
+
+    Returns:
+        pyarrow.dataset.Expression or None: The filter, None if there is nothing to filter.
+    """
+    original_names = {col.split('/')[0]: col for col in schema.names}
+    filters = []
+
+    if poliza_ids is not None:
+        poliza_ids = np.atleast_1d(poliza_ids).tolist()
+        filters.append(ds.field(original_names[poliza_column]).isin(poliza_ids))
+
+    if start_date is not None or end_date is not None:
+        date_field = ds.field(original_names[date_column])
+        date_type = schema.field(original_names[date_column]).type
+        is_string = pa.types.is_string(date_type) or pa.types.is_large_string(date_type)
+        if start_date is not None:
+            start_date = pd.Timestamp(start_date)
+            filters.append(date_field >= (start_date.strftime("%Y-%m-%d") if is_string else start_date))
+        if end_date is not None:
+            end_date = pd.Timestamp(end_date)
+            if is_string:
+                filters.append(date_field < (end_date + pd.Timedelta(days=1)).strftime("%Y-%m-%d"))
+            else:
+                filters.append(date_field <= end_date)
+
+    return functools.reduce(operator.and_, filters) if filters else None
+
+
+def seccio_censal_to_str(values):
+    """
+    Vectorized SECCIO_CENSAL normalization: numeric codes (often read as floats)
+    become 10-digit zero-padded strings, missing codes stay missing.
+
+    Only the distinct codes are formatted (there are a few thousand sections
+    against millions of readings), and the result is a categorical whose
+    categories are the normalized codes.
+    """
+    values = pd.Series(values)
+    codes = np.trunc(pd.to_numeric(values, errors="coerce"))
+    positions, uniques = pd.factorize(codes, sort=True)
+    categories = pd.Series(uniques).astype("Int64").astype("string").str.zfill(10)
+    normalized = pd.Categorical.from_codes(positions, categories=categories.astype(str))
+    return pd.Series(normalized, index=values.index, name="SECCIO_CENSAL_STR")
+
+
+def poliza_bucket(polizas, n_buckets=N_POLIZA_BUCKETS):
+    """
+    Stable hash bucket (same across runs and processes) of every POLIZA_SUMINISTRO.
+    """
+    values = np.asarray(polizas, dtype=object).astype(str).astype(object)
+    return (pd.util.hash_array(values) % n_buckets).astype("int32")
+
+
+def write_partitioned_dataset(source_path, dataset_dir, n_buckets=N_POLIZA_BUCKETS,
+                              batch_size=1_000_000, row_group_size=50_000):
+    """
+    Rewrites an ICI parquet file as a dataset partitioned by póliza hash bucket
+    and month (hive layout: poliza_bucket=<b>/month=<YYYY-MM>/), with every
+    partition sorted by (POLIZA_SUMINISTRO, FECHA).
+
+    The source is streamed in row-group batches into the partitions first, and
+    each partition is then sorted on its own, so memory stays bounded by the
+    largest partition instead of the whole file. Small row groups keep the
+    POLIZA_SUMINISTRO / FECHA statistics selective for `read_partitioned_dataset`.
+
+    Args:
+        source_path (str): Path to the .parquet file (e.g. the cleaned ICI data).
+        dataset_dir (str): Output directory, replaced if it exists.
+        n_buckets (int): Number of póliza hash buckets.
+        batch_size (int): Rows read from the source at a time.
+        row_group_size (int): Maximum rows per row group in the output files.
+    """
+    staging_dir = dataset_dir.rstrip("/") + ".staging"
+    for path in (staging_dir, dataset_dir):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+    # --- Pass 1: stream batches into their partitions ---
+    parquet_file = pq.ParquetFile(source_path)
+    for i, batch in enumerate(parquet_file.iter_batches(batch_size=batch_size)):
+        batch = batch.rename_columns([col.split('/')[0] for col in batch.schema.names])
+        df = batch.to_pandas()
+        df["FECHA"] = pd.to_datetime(df["FECHA"])
+        df["poliza_bucket"] = poliza_bucket(df["POLIZA_SUMINISTRO"], n_buckets)
+        df["month"] = df["FECHA"].dt.strftime("%Y-%m")
+        # a batch spanning several years touches up to n_buckets x months
+        # partitions, more than write_dataset's default limit of 1024
+        n_partitions = len(df[PARTITION_COLUMNS].drop_duplicates())
+        ds.write_dataset(
+            pa.Table.from_pandas(df, preserve_index=False),
+            staging_dir,
+            format="parquet",
+            partitioning=PARTITION_COLUMNS,
+            partitioning_flavor="hive",
+            basename_template=f"batch-{i}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            max_partitions=max(n_partitions, 1024),
+        )
+
+    # --- Pass 2: sort every partition by POLIZA_SUMINISTRO, FECHA ---
+    for root, _, files in os.walk(staging_dir):
+        if not any(f.endswith(".parquet") for f in files):
+            continue
+        table = pq.read_table(root).sort_by([("POLIZA_SUMINISTRO", "ascending"), ("FECHA", "ascending")])
+        out_dir = os.path.join(dataset_dir, os.path.relpath(root, staging_dir))
+        os.makedirs(out_dir, exist_ok=True)
+        pq.write_table(table, os.path.join(out_dir, "part-0.parquet"), row_group_size=row_group_size)
+
+    shutil.rmtree(staging_dir, ignore_errors=True)
+    with open(os.path.join(dataset_dir, "_partitioning.json"), "w") as f:
+        json.dump({"n_buckets": n_buckets, "partitioning": PARTITION_COLUMNS}, f)
+
+
+def read_partitioned_dataset(dataset_dir, poliza_ids=None, start_date=None, end_date=None, columns=None):
+    """
+    Reads rows from a dataset written by `write_partitioned_dataset`, pushing
+    the póliza and date predicates down to the partitions and row groups.
+
+    Args:
+        dataset_dir (str): Dataset directory.
+        poliza_ids (str or list, optional): POLIZA_SUMINISTRO value(s) to read.
+        start_date, end_date (date-like, optional): Inclusive FECHA range to read.
+        columns (list, optional): Columns to read, all of them if None.
+
+    Returns:
+        pandas.DataFrame: The matching rows, sorted by POLIZA_SUMINISTRO and FECHA
+            within each partition.
+    """
+    with open(os.path.join(dataset_dir, "_partitioning.json")) as f:
+        n_buckets = json.load(f)["n_buckets"]
+    dataset = ds.dataset(dataset_dir, format="parquet", partitioning="hive")
+
+    # partition pruning on top of the row filters
+    filters = []
+    if poliza_ids is not None:
+        poliza_ids = [str(p) for p in np.atleast_1d(poliza_ids)]
+        buckets = np.unique(poliza_bucket(poliza_ids, n_buckets)).tolist()
+        filters.append(ds.field("poliza_bucket").isin(buckets))
+    if start_date is not None:
+        filters.append(ds.field("month") >= pd.Timestamp(start_date).strftime("%Y-%m"))
+    if end_date is not None:
+        filters.append(ds.field("month") <= pd.Timestamp(end_date).strftime("%Y-%m"))
+    row_filter = build_filter(dataset.schema, poliza_ids, start_date, end_date)
+    if row_filter is not None:
+        filters.append(row_filter)
+
+    if columns is None:
+        columns = [c for c in dataset.schema.names if c not in PARTITION_COLUMNS]
+    expression = functools.reduce(operator.and_, filters) if filters else None
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
@@ -0,0 +1,183 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+from xgboost import XGBRegressor
+
+from src.predict_next_month_TC import (
+    FEATURES,
+    TARGET,
+    XGB_PARAMS,
+    build_features_all_polizas,
+    recent_windows_all_polizas,
+    recursive_forecast_batch,
+)
+
+# Static meter / location attributes shared by all readings of a póliza
+STATIC_FEATURES = ["US_AIGUA_GEST", "CODI_MODEL", "DIAM_COMP", "SECCIO_CENSAL"]
+CATEGORICAL_FEATURES = ["US_AIGUA_GEST", "CODI_MODEL", "SECCIO_CENSAL"]
+
+# Consumption-scale features, divided by each meter's mean consumption
+NORMALIZED_FEATURES = ["lag_1", "lag_7", "rolling_mean_7"]
+
+
+def static_attributes(df):
+    """
+    Returns one row per POLIZA_SUMINISTRO with its last known static attributes.
+    """
+    columns = [c for c in STATIC_FEATURES if c in df.columns]
+    return df.groupby("POLIZA_SUMINISTRO")[columns].last()
+
+
+class GlobalConsumptionModel:
+    """
+    Single forecasting model trained over all pólisses at once.
+
+    Lag and rolling features (and the target) are normalized by each meter's
+    mean consumption so that meters of very different sizes share one model,
+    and the static attributes in STATIC_FEATURES let it tell them apart.
+    Meters with short histories borrow strength from the rest of the fleet.
+
+    Use `bind` to get a predictor for a fixed list of pólisses that accepts the
+    same FEATURES as the per-póliza models, so it plugs directly into
+    `recursive_forecast` / `recursive_forecast_batch`.
+    """
+
+    def __init__(self, params=None):
+        self.params = dict(params or XGB_PARAMS)
+        self.model = None
+        self.scales = None
+        self.statics = None
+        self.categories = {}
+
+    def knows(self, poliza_id):
+        return self.scales is not None and poliza_id in self.scales.index
+
+    def _static_frame(self, poliza_ids):
+        statics = self.statics.reindex(poliza_ids).reset_index(drop=True)
+        for col, categories in self.categories.items():
+            statics[col] = pd.Categorical(statics[col].astype(str), categories=categories)
+        return statics
+
+    def _design_matrix(self, X, scales, statics):
+        X = X[FEATURES].reset_index(drop=True).astype(float)
+        X[NORMALIZED_FEATURES] = X[NORMALIZED_FEATURES].div(scales, axis=0)
+        return pd.concat([X, statics], axis=1)
+
+    def fit(self, df):
+        """
+        Trains the global model on the ICI data of every póliza.
+
+        Args:
+            df (pandas.DataFrame): ICI data with POLIZA_SUMINISTRO, FECHA, CONSUMO_REAL
+                and (optionally) the STATIC_FEATURES columns.
+
+        Returns:
+            GlobalConsumptionModel: self
+        """
+        df_features = build_features_all_polizas(df)
+
+        scales = df_features.groupby("POLIZA_SUMINISTRO")[TARGET].mean()
+        self.scales = scales.where(scales > 0, 1.0).fillna(1.0)
+
+        self.statics = static_attributes(df)
+        self.categories = {
+            col: sorted(self.statics[col].dropna().astype(str).unique())
+            for col in CATEGORICAL_FEATURES if col in self.statics.columns
+        }
+        for col in self.statics.columns:
+            if col not in self.categories:
+                self.statics[col] = pd.to_numeric(self.statics[col], errors="coerce")
+
+        train = df_features.dropna(subset=FEATURES + [TARGET])
+        poliza_ids = train["POLIZA_SUMINISTRO"].to_numpy()
+        scales = self.scales.reindex(poliza_ids).to_numpy()
+
+        X = self._design_matrix(train, scales, self._static_frame(poliza_ids))
+        y = train[TARGET].to_numpy() / scales
+
+        self.model = XGBRegressor(**self.params, enable_categorical=True)
+        self.model.fit(X, y)
+        return self
+
+    def bind(self, poliza_ids):
+        """
+        Returns a predictor for the given pólisses (one row per póliza, in order).
+        """
+        return _BoundGlobalModel(self, list(poliza_ids))
+
+    def forecast(self, df_features, forecast_days=30):
+        """
+        Forecasts every known póliza in a single batched recursive run.
+
+        Args:
+            df_features (pandas.DataFrame): Output of `build_features_all_polizas`.
+            forecast_days (int): Number of days to forecast.
+
+        Returns:
+            pandas.DataFrame: Tidy (POLIZA_SUMINISTRO, FECHA, CONSUMO_REAL) forecast table.
+        """
+        df_known = df_features[
+            df_features["POLIZA_SUMINISTRO"].isin(self.scales.index) & df_features[TARGET].notna()
+        ]
+        columns = ["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"]
+        if df_known.empty:
+            return pd.DataFrame(columns=columns)
+
+        poliza_ids, last_dates, windows = recent_windows_all_polizas(df_known)
+        predictions = recursive_forecast_batch(self.bind(poliza_ids), last_dates, windows, forecast_days)
+
+        horizon = np.arange(1, forecast_days + 1)
+        dates = last_dates.to_numpy()[:, None] + horizon * np.timedelta64(1, "D")
+        return pd.DataFrame({
+            "POLIZA_SUMINISTRO": np.repeat(poliza_ids, forecast_days),
+            "FECHA": dates.ravel(),
+            "CONSUMO_REAL": predictions.ravel(),
+        })[columns]
+
+    def save(self, model_dir):
+        """
+        Saves the booster and the per-póliza scales / attributes to `model_dir`.
+        """
+        os.makedirs(model_dir, exist_ok=True)
+        self.model.save_model(os.path.join(model_dir, "global_model.json"))
+        self.scales.rename("scale").to_frame().join(self.statics).to_parquet(
+            os.path.join(model_dir, "global_model_polizas.parquet")
+        )
+        with open(os.path.join(model_dir, "global_model_meta.json"), "w") as f:
+            json.dump({"params": self.params, "categories": self.categories}, f)
+
+    @classmethod
+    def load(cls, model_dir):
+        """
+        Loads a model previously written with `save`.
+        """
+        with open(os.path.join(model_dir, "global_model_meta.json")) as f:
+            meta = json.load(f)
+        global_model = cls(meta["params"])
+        global_model.categories = meta["categories"]
+
+        polizas = pd.read_parquet(os.path.join(model_dir, "global_model_polizas.parquet"))
+        global_model.scales = polizas["scale"]
+        global_model.statics = polizas.drop(columns="scale")
+
+        global_model.model = XGBRegressor(enable_categorical=True)
+        global_model.model.load_model(os.path.join(model_dir, "global_model.json"))
+        return global_model
+
+
+class _BoundGlobalModel:
+    """
+    Global model restricted to a fixed list of pólisses, exposing `predict`
+    on raw-scale FEATURES like a per-póliza model.
+    """
+
+    def __init__(self, global_model, poliza_ids):
+        self.global_model = global_model
+        self.scales = global_model.scales.reindex(poliza_ids).to_numpy()
+        self.statics = global_model._static_frame(poliza_ids)
+
+    def predict(self, X):
+        X = self.global_model._design_matrix(X, self.scales, self.statics)
+        return self.global_model.model.predict(X) * self.scales
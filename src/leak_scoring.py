@@ -0,0 +1,204 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.dataset as ds
+from xgboost import XGBClassifier
+
+from src.data_preprocessing import load_parquet_to_df
+
+# FEC identifies the póliza as POLISSA_SUBM; the leak notification date is
+# the incident date
+FEC_POLIZA = "POLISSA_SUBM"
+FEC_INCIDENT_DATE = "CREATED_MENSAJE"
+
+ICI_COLUMNS = ["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"]
+LEAK_FEATURES = ["FLOOR_7", "FLOOR_RATIO", "MEAN_RATIO_14", "DAYS_ABOVE_14", "BASELINE_90"]
+LEAK_TARGET = "LEAK"
+
+LEAK_PARAMS = {
+    "n_estimators": 200,
+    "learning_rate": 0.05,
+    "max_depth": 4,
+    "subsample": 0.8,
+    "colsample_bytree": 0.8,
+    "random_state": 42,
+    "tree_method": "hist",
+}
+
+
+def _poliza_keys(values):
+    # FEC may read the póliza as a number while ICI keeps it as text
+    values = pd.Series(values)
+    if pd.api.types.is_numeric_dtype(values):
+        values = values.astype("Int64")
+    return values.astype(str)
+
+
+def load_incidents(fec_path):
+    """
+    Reads only the póliza and incident date columns of the (cleaned) FEC data.
+
+    Returns:
+        pandas.DataFrame: POLIZA_SUMINISTRO and INCIDENT_DATE of every leak incident,
+            sorted by INCIDENT_DATE.
+    """
+    fec = load_parquet_to_df(fec_path, columns=[FEC_POLIZA, FEC_INCIDENT_DATE]).dropna()
+    incidents = pd.DataFrame({
+        "POLIZA_SUMINISTRO": _poliza_keys(fec[FEC_POLIZA]).to_numpy(),
+        "INCIDENT_DATE": pd.to_datetime(fec[FEC_INCIDENT_DATE]).dt.normalize().to_numpy(),
+    })
+    return incidents.drop_duplicates().sort_values("INCIDENT_DATE", kind="stable").reset_index(drop=True)
+
+
+def _grouped_rolling(values, groups, window, min_periods, how, *args):
+    rolling = values.groupby(groups, sort=False).rolling(window=window, min_periods=min_periods)
+    return getattr(rolling, how)(*args).reset_index(level=0, drop=True)
+
+
+def leak_features(df):
+    """
+    Windowed leak features of every póliza and day, in one grouped pass.
+
+    Readings are daily, so the night-flow floor is approximated by the lowest
+    daily consumption of the last week: a continuous leak raises the floor
+    of a meter, not only its peaks. Baselines use the 90 days before that week.
+
+    - FLOOR_7: minimum daily consumption of the last 7 days.
+    - BASELINE_90: median daily consumption of the 90 days before.
+    - FLOOR_RATIO: FLOOR_7 over the 10% quantile of those 90 days.
+    - MEAN_RATIO_14: mean of the last 14 days over BASELINE_90.
+    - DAYS_ABOVE_14: days of the last 14 above 1.5 x BASELINE_90 (sustained increase).
+
+    Args:
+        df (pandas.DataFrame): ICI data with POLIZA_SUMINISTRO, FECHA and CONSUMO_REAL.
+
+    Returns:
+        pandas.DataFrame: Rows sorted by (POLIZA_SUMINISTRO, FECHA) with LEAK_FEATURES.
+    """
+    df_ = df[ICI_COLUMNS].dropna(subset=["FECHA"]).copy()
+    df_["POLIZA_SUMINISTRO"] = _poliza_keys(df_["POLIZA_SUMINISTRO"]).to_numpy()
+    df_["FECHA"] = pd.to_datetime(df_["FECHA"]).dt.normalize()
+    df_ = df_.sort_values(["POLIZA_SUMINISTRO", "FECHA"], kind="stable").reset_index(drop=True)
+
+    groups = df_["POLIZA_SUMINISTRO"]
+    consumption = df_["CONSUMO_REAL"]
+    before_week = consumption.groupby(groups, sort=False).shift(7)
+
+    df_["FLOOR_7"] = _grouped_rolling(consumption, groups, 7, 5, "min")
+    df_["BASELINE_90"] = _grouped_rolling(before_week, groups, 90, 30, "median")
+    baseline_floor = _grouped_rolling(before_week, groups, 90, 30, "quantile", 0.1)
+
+    baseline = df_["BASELINE_90"].where(df_["BASELINE_90"] > 0)
+    df_["FLOOR_RATIO"] = df_["FLOOR_7"] / baseline_floor.where(baseline_floor > 0, baseline)
+    df_["MEAN_RATIO_14"] = _grouped_rolling(consumption, groups, 14, 7, "mean") / baseline
+    above = (consumption > 1.5 * df_["BASELINE_90"]).astype(float).where(df_["BASELINE_90"].notna())
+    df_["DAYS_ABOVE_14"] = _grouped_rolling(above, groups, 14, 7, "sum")
+    return df_
+
+
+def label_incidents(features, incidents, horizon_days=30):
+    """
+    Labels every (póliza, day) with LEAK = 1 when the póliza has a FEC incident
+    in the next `horizon_days` days, with a forward merge_asof on the sorted dates.
+    """
+    incidents = incidents.assign(POLIZA_SUMINISTRO=_poliza_keys(incidents["POLIZA_SUMINISTRO"]).to_numpy())
+    labeled = pd.merge_asof(
+        features.sort_values("FECHA", kind="stable"),
+        incidents.sort_values("INCIDENT_DATE", kind="stable"),
+        left_on="FECHA",
+        right_on="INCIDENT_DATE",
+        by="POLIZA_SUMINISTRO",
+        direction="forward",
+        tolerance=pd.Timedelta(days=horizon_days),
+    )
+    labeled[LEAK_TARGET] = labeled["INCIDENT_DATE"].notna().astype(int)
+    return labeled.sort_values(["POLIZA_SUMINISTRO", "FECHA"], kind="stable").reset_index(drop=True)
+
+
+def iter_meter_chunks(ici_path, columns=None):
+    """
+    Yields the ICI readings split in groups of whole pólisses.
+
+    A dataset written by `write_partitioned_dataset` is read one póliza bucket
+    at a time, so memory is bounded by the largest bucket; a single parquet
+    file is read in one go. Only `columns` (ICI_COLUMNS by default) are read.
+    """
+    columns = columns or ICI_COLUMNS
+    partitioning_path = os.path.join(ici_path, "_partitioning.json")
+    if not os.path.exists(partitioning_path):
+        yield load_parquet_to_df(ici_path, columns=columns)
+        return
+
+    with open(partitioning_path) as f:
+        n_buckets = json.load(f)["n_buckets"]
+    dataset = ds.dataset(ici_path, format="parquet", partitioning="hive")
+    for bucket in range(n_buckets):
+        table = dataset.to_table(columns=columns, filter=ds.field("poliza_bucket") == bucket)
+        if table.num_rows:
+            yield table.to_pandas()
+
+
+def build_training_set(ici_path, fec_path, horizon_days=30, every_days=7):
+    """
+    Leak features labeled with the FEC incidents, built chunk by chunk.
+
+    Only one snapshot every `every_days` days is kept per póliza, which keeps
+    the training set small without losing the days around the incidents
+    (labels look `horizon_days` ahead).
+
+    Returns:
+        pandas.DataFrame: Snapshots with POLIZA_SUMINISTRO, FECHA, LEAK_FEATURES and LEAK.
+    """
+    incidents = load_incidents(fec_path)
+    snapshots = []
+    for chunk in iter_meter_chunks(ici_path):
+        features = leak_features(chunk)
+        features = features[(features["FECHA"] - features["FECHA"].min()).dt.days % every_days == 0]
+        labeled = label_incidents(features.dropna(subset=["BASELINE_90"]), incidents, horizon_days)
+        snapshots.append(labeled[["POLIZA_SUMINISTRO", "FECHA"] + LEAK_FEATURES + [LEAK_TARGET]])
+    return pd.concat(snapshots, ignore_index=True)
+
+
+def train_leak_model(training_set, params=None):
+    """
+    Fits an XGBoost classifier of the FEC leak label on the leak features.
+    """
+    model = XGBClassifier(**(params or LEAK_PARAMS))
+    model.fit(training_set[LEAK_FEATURES], training_set[LEAK_TARGET])
+    return model
+
+
+def score_meters(model, features, as_of=None):
+    """
+    Leak probability of every meter on its latest day up to `as_of`.
+
+    Returns:
+        pandas.DataFrame: POLIZA_SUMINISTRO, FECHA, LEAK_FEATURES and LEAK_PROBABILITY.
+    """
+    if as_of is not None:
+        features = features[features["FECHA"] <= pd.Timestamp(as_of)]
+    latest = features.groupby("POLIZA_SUMINISTRO", sort=False).tail(1).reset_index(drop=True)
+    latest["LEAK_PROBABILITY"] = model.predict_proba(latest[LEAK_FEATURES])[:, 1]
+    return latest[["POLIZA_SUMINISTRO", "FECHA"] + LEAK_FEATURES + ["LEAK_PROBABILITY"]]
+
+
+def score_all_meters(model, ici_path, as_of=None, top_n=None):
+    """
+    Scores every meter of the ICI data chunk by chunk and ranks them by leak
+    probability, e.g. to prioritise the day's field inspections.
+
+    Returns:
+        pandas.DataFrame: One row per póliza with its rank and LEAK_PROBABILITY,
+            highest first.
+    """
+    scores = pd.concat(
+        [score_meters(model, leak_features(chunk), as_of) for chunk in iter_meter_chunks(ici_path)],
+        ignore_index=True,
+    )
+    scores = scores.sort_values("LEAK_PROBABILITY", ascending=False, kind="stable").reset_index(drop=True)
+    if top_n is not None:
+        scores = scores.head(top_n)
+    scores.insert(0, "rank", np.arange(1, len(scores) + 1))
+    return scores
@@ -0,0 +1,135 @@
+import numpy as np
+import pandas as pd
+
+from src.cleaning import ANOMALY_MAP
+
+BROKEN_METER = ANOMALY_MAP[32768]
+# 163840: consecutive periods with the same meter reading, i.e. zero consumption
+REPEATED_READING = ANOMALY_MAP[163840]
+# not RCA codes
+CONSTANT_CONSUMPTION = "CONSUMO_CONSTANT"
+SPIKE = "PIC_CONSUM"
+
+EVENT_COLUMNS = ["POLIZA_SUMINISTRO", "START_DATE", "END_DATE", "N_DAYS", "CONSUMO_REAL", "CODI_ANOMALIA"]
+
+
+def run_lengths(df):
+    """
+    Run-length encoding of the daily readings of every póliza.
+
+    The readings are sorted once by (POLIZA_SUMINISTRO, FECHA) and a new run
+    starts wherever the póliza or the consumption changes, or where days are
+    missing between two readings; missing consumptions never form a run.
+
+    Args:
+        df (pandas.DataFrame): ICI data with POLIZA_SUMINISTRO, FECHA and CONSUMO_REAL.
+
+    Returns:
+        pandas.DataFrame: One row per run with POLIZA_SUMINISTRO, START_DATE,
+            END_DATE, N_DAYS and its CONSUMO_REAL.
+    """
+    df_ = df[["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"]].dropna()
+    df_ = df_.sort_values(["POLIZA_SUMINISTRO", "FECHA"], kind="stable")
+
+    polizas = df_["POLIZA_SUMINISTRO"].to_numpy()
+    dates = pd.to_datetime(df_["FECHA"]).dt.normalize().to_numpy()
+    values = df_["CONSUMO_REAL"].to_numpy(dtype=float)
+
+    starts = np.ones(len(df_), dtype=bool)
+    starts[1:] = (
+        (polizas[1:] != polizas[:-1])
+        | (values[1:] != values[:-1])
+        | (dates[1:] - dates[:-1] != np.timedelta64(1, "D"))
+    )
+    first = np.flatnonzero(starts)
+    last = np.r_[first[1:], len(df_)] - 1
+
+    return pd.DataFrame({
+        "POLIZA_SUMINISTRO": polizas[first],
+        "START_DATE": dates[first],
+        "END_DATE": dates[last],
+        "N_DAYS": last - first + 1,
+        "CONSUMO_REAL": values[first],
+    })
+
+
+def detect_spikes(df, factor=10.0, min_liters=1000.0):
+    """
+    Readings implausibly high for their meter: more than `factor` times the
+    póliza's median daily consumption and above `min_liters`.
+
+    Returns:
+        pandas.DataFrame: One event per spike (EVENT_COLUMNS, N_DAYS = 1).
+    """
+    df_ = df[["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"]].dropna()
+    median = df_.groupby("POLIZA_SUMINISTRO", sort=False)["CONSUMO_REAL"].transform("median")
+    spikes = df_[(df_["CONSUMO_REAL"] > factor * median) & (df_["CONSUMO_REAL"] > min_liters)]
+
+    dates = pd.to_datetime(spikes["FECHA"]).dt.normalize()
+    return pd.DataFrame({
+        "POLIZA_SUMINISTRO": spikes["POLIZA_SUMINISTRO"].to_numpy(),
+        "START_DATE": dates.to_numpy(),
+        "END_DATE": dates.to_numpy(),
+        "N_DAYS": 1,
+        "CONSUMO_REAL": spikes["CONSUMO_REAL"].to_numpy(),
+        "CODI_ANOMALIA": SPIKE,
+    })
+
+
+def detect_meter_anomalies(df, min_zero_days=7, min_constant_days=3, stuck_days=30, spike_factor=10.0,
+                           spike_min_liters=1000.0):
+    """
+    Flags the patterns behind the RCA anomaly codes directly in the ICI daily
+    telemetry of all pólisses, from one run-length encoding of the data:
+
+    - LECTURA_REPETIDA (163840): the meter reading does not change, i.e.
+      zero consumption, on at least `min_zero_days` consecutive days.
+    - CONTADOR_AVERIADO (32768): the same non-zero daily consumption for at
+      least `stuck_days` consecutive days (a meter reporting a fixed value).
+    - CONSUMO_CONSTANT (not an RCA code): the same non-zero daily consumption
+      on at least `min_constant_days` consecutive days, but fewer than `stuck_days`.
+    - PIC_CONSUM (not an RCA code): implausible spikes (see `detect_spikes`).
+
+    Args:
+        df (pandas.DataFrame): ICI data with POLIZA_SUMINISTRO, FECHA and CONSUMO_REAL.
+        min_zero_days (int): Shortest run of zero consumption flagged.
+        min_constant_days (int): Shortest run of identical non-zero consumption flagged.
+        stuck_days (int): Shortest run of identical non-zero consumption considered a broken meter.
+        spike_factor (float): Spike threshold as a multiple of the meter's median.
+        spike_min_liters (float): Minimum consumption of a spike.
+
+    Returns:
+        pandas.DataFrame: One row per event (EVENT_COLUMNS, RCA-like START_DATE /
+            END_DATE / CODI_ANOMALIA), sorted by póliza and start date.
+    """
+    runs = run_lengths(df)
+
+    is_zero = runs["CONSUMO_REAL"] == 0
+    codes = np.select(
+        [
+            is_zero & (runs["N_DAYS"] >= min_zero_days),
+            ~is_zero & (runs["N_DAYS"] >= stuck_days),
+            ~is_zero & (runs["N_DAYS"] >= min_constant_days),
+        ],
+        [REPEATED_READING, BROKEN_METER, CONSTANT_CONSUMPTION],
+        default="",
+    )
+    events = runs.assign(CODI_ANOMALIA=codes)[codes != ""]
+
+    events = pd.concat([events, detect_spikes(df, spike_factor, spike_min_liters)], ignore_index=True)
+    return events.sort_values(["POLIZA_SUMINISTRO", "START_DATE"], kind="stable").reset_index(drop=True)[
+        EVENT_COLUMNS
+    ]
+
+
+def flagged_meters(events, as_of=None, lookback_days=30):
+    """
+    Meters with events ending in the last `lookback_days` days up to `as_of`
+    (latest END_DATE if None), with the number of events per code.
+
+    Returns:
+        pandas.DataFrame: One row per POLIZA_SUMINISTRO and one column per CODI_ANOMALIA.
+    """
+    as_of = pd.Timestamp(as_of) if as_of is not None else events["END_DATE"].max()
+    recent = events[events["END_DATE"] > as_of - pd.Timedelta(days=lookback_days)]
+    return pd.crosstab(recent["POLIZA_SUMINISTRO"], recent["CODI_ANOMALIA"])
@@ -0,0 +1,326 @@
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+from xgboost import XGBRegressor
+
+from src.data_access import PROJECT_ROOT
+from src.predict_next_month_TC import (
+    FEATURES,
+    QUANTILE_PARAMS,
+    TARGET,
+    XGB_PARAMS,
+    build_direct_features,
+    train_consumption_model,
+    train_direct_model,
+    train_quantile_model,
+)
+
+MODELS_DIR = os.path.join(PROJECT_ROOT, "models")
+
+# suffix of files being written (keeps the .json extension XGBoost picks the format from)
+TMP_SUFFIX = ".tmp.json"
+
+_lock = threading.Lock()
+# the ModelStore of every store directory
+_stores = {}
+
+
+def hash_params(params):
+    """
+    Stable hash of a hyperparameter dictionary.
+    """
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def hash_training_data(df_features):
+    """
+    Stable hash of the rows a model is trained on (features + target).
+    """
+    row_hashes = pd.util.hash_pandas_object(df_features[FEATURES + [TARGET]], index=False)
+    return hashlib.sha1(row_hashes.values.tobytes()).hexdigest()
+
+
+class ModelStore:
+    """
+    On-disk registry of trained per-póliza forecasting models.
+
+    Models are saved as XGBoost JSON files keyed by póliza and by the hash of
+    the hyperparameters, with a metadata file recording the hash and last
+    FECHA of the data they were trained on. A stored model is reused when the
+    training data is unchanged, or when the newest reading is at most
+    `staleness_days` days past the model's last training date; otherwise the
+    model is retrained and overwritten.
+
+    With `update_rounds` set, a stale model is not retrained from scratch:
+    boosting continues from the stored booster for `update_rounds` extra
+    trees fitted on the new rows only. After `max_updates` incremental
+    updates the model is fully retrained again to bound its size.
+
+    Recently used models are also kept in memory, and both the in-memory and
+    on-disk caches are capped with least-recently-used eviction.
+
+    A store can be shared by several threads: its caches are guarded by a
+    lock, and files are written to temporary paths and moved into place.
+
+    Args:
+        store_dir (str): Directory where models are persisted.
+        staleness_days (int): Days of new readings tolerated before retraining.
+        max_models (int): Maximum number of models kept on disk.
+        max_in_memory (int): Maximum number of models kept loaded in memory.
+        params (dict): XGBoost hyperparameters, defaults to XGB_PARAMS.
+        update_rounds (int): Trees added per incremental update, None to always retrain.
+        max_updates (int): Incremental updates allowed before a full retrain.
+    """
+
+    def __init__(self, store_dir, staleness_days=7, max_models=10000, max_in_memory=256, params=None,
+                 update_rounds=None, max_updates=30):
+        self.store_dir = store_dir
+        self.staleness_days = staleness_days
+        self.update_rounds = update_rounds
+        self.max_updates = max_updates
+        self.max_models = max_models
+        self.max_in_memory = max_in_memory
+        self.params = dict(params or XGB_PARAMS)
+        self.params_hash = hash_params(self.params)
+        self._memory = OrderedDict()
+        # the store is shared by every session thread (see get_shared_model_store)
+        self._lock = threading.RLock()
+
+        os.makedirs(store_dir, exist_ok=True)
+        self._n_models = len(self._stored_model_files())
+
+    def _stored_model_files(self):
+        return [
+            f for f in os.listdir(self.store_dir)
+            if f.endswith(".json") and not f.endswith(".meta.json") and not f.endswith(TMP_SUFFIX)
+        ]
+
+    def _key(self, poliza_id, params_hash=None):
+        safe_id = "".join(c if c.isalnum() else "_" for c in str(poliza_id))
+        # the id hash keeps apart pólisses whose ids only differ in replaced characters
+        id_hash = hashlib.sha1(str(poliza_id).encode()).hexdigest()[:8]
+        return f"{safe_id}_{id_hash}_{(params_hash or self.params_hash)[:12]}"
+
+    def _paths(self, key):
+        model_path = os.path.join(self.store_dir, f"{key}.json")
+        meta_path = os.path.join(self.store_dir, f"{key}.meta.json")
+        return model_path, meta_path
+
+    def _tmp_path(self, path):
+        return f"{path[:-len('.json')]}.{os.getpid()}-{threading.get_ident()}{TMP_SUFFIX}"
+
+    def _remember(self, key, model, meta):
+        self._memory[key] = (model, meta)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_in_memory:
+            self._memory.popitem(last=False)
+
+    def _load(self, key, poliza_id):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                stored = self._memory[key]
+            else:
+                model_path, meta_path = self._paths(key)
+                if not (os.path.exists(model_path) and os.path.exists(meta_path)):
+                    return None
+
+                model = XGBRegressor()
+                model.load_model(model_path)
+                with open(meta_path) as f:
+                    meta = json.load(f)
+                self._remember(key, model, meta)
+                stored = model, meta
+            # a model trained for another póliza is a miss
+            if stored[1]["poliza_id"] != str(poliza_id):
+                return None
+            return stored
+
+    def _is_fresh(self, meta, data_hash, last_date):
+        if meta["data_hash"] == data_hash:
+            return True
+        new_days = (last_date - pd.Timestamp(meta["last_date"])).days
+        return 0 <= new_days <= self.staleness_days
+
+    def _save(self, key, model, meta):
+        with self._lock:
+            model_path, meta_path = self._paths(key)
+            is_new = not os.path.exists(model_path)
+
+            # written to temporary files and moved into place, the metadata last, so
+            # a reader never sees a half-written file or new metadata with an old model
+            tmp_model_path, tmp_meta_path = (self._tmp_path(path) for path in (model_path, meta_path))
+            model.save_model(tmp_model_path)
+            with open(tmp_meta_path, "w") as f:
+                json.dump(meta, f)
+            os.replace(tmp_model_path, model_path)
+            os.replace(tmp_meta_path, meta_path)
+            self._remember(key, model, meta)
+
+            if is_new:
+                self._n_models += 1
+                if self._n_models > self.max_models:
+                    self._evict()
+
+    def _evict(self):
+        with self._lock:
+            # least recently used = oldest modification time (touched on every hit)
+            files = sorted(
+                self._stored_model_files(),
+                key=lambda f: os.path.getmtime(os.path.join(self.store_dir, f)),
+            )
+            excess = len(files) - self.max_models
+            for file_name in files[:max(excess, 0)]:
+                key = file_name[:-len(".json")]
+                for path in self._paths(key):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._memory.pop(key, None)
+            self._n_models = len(files) - max(excess, 0)
+
+    def _touch(self, key):
+        with self._lock:
+            model_path, _ = self._paths(key)
+            if os.path.exists(model_path):
+                os.utime(model_path)
+
+    def _metadata(self, poliza_id, df_features, n_updates=0, params=None):
+        return {
+            "poliza_id": str(poliza_id),
+            "data_hash": hash_training_data(df_features),
+            "params_hash": hash_params(params) if params else self.params_hash,
+            "last_date": pd.Timestamp(df_features["FECHA"].max()).isoformat(),
+            "n_rows": int(len(df_features)),
+            "n_updates": n_updates,
+        }
+
+    def update_model(self, poliza_id, df_features, params=None):
+        """
+        Continues boosting the stored model of `poliza_id` with the rows of
+        `df_features` newer than its last training date.
+
+        Args:
+            poliza_id (str): POLIZA_SUMINISTRO the model belongs to.
+            df_features (pandas.DataFrame): Feature-engineered rows (no NaN), old and new.
+            params (dict, optional): Hyperparameters of the model, the store's if None.
+
+        Returns:
+            xgboost.XGBRegressor: The updated model, or None when there is no stored
+                model or no new rows to learn from.
+        """
+        with self._lock:
+            params = params or self.params
+            key = self._key(poliza_id, hash_params(params))
+            stored = self._load(key, poliza_id)
+            if stored is None:
+                return None
+
+            old_model, meta = stored
+            new_rows = df_features[df_features["FECHA"] > pd.Timestamp(meta["last_date"])]
+            if new_rows.empty:
+                return None
+
+            model = XGBRegressor(**dict(params, n_estimators=self.update_rounds or 10))
+            model.fit(new_rows[FEATURES], new_rows[TARGET], xgb_model=old_model.get_booster())
+
+            self._save(key, model, self._metadata(poliza_id, df_features, meta.get("n_updates", 0) + 1, params))
+            return model
+
+    def get_model(self, poliza_id, df_features, params=None):
+        """
+        Returns a model for `poliza_id`, loading it from the store when it is
+        still fresh for `df_features` and retraining (and saving) it otherwise.
+        Stale models are updated incrementally instead when `update_rounds` is set.
+
+        Args:
+            poliza_id (str): POLIZA_SUMINISTRO the model belongs to.
+            df_features (pandas.DataFrame): Feature-engineered training rows (no NaN).
+            params (dict, optional): Hyperparameters overriding the store's (e.g. tuned
+                for the póliza's segment); models are stored per hyperparameter hash.
+
+        Returns:
+            xgboost.XGBRegressor: The fitted model.
+        """
+        with self._lock:
+            params = params or self.params
+            key = self._key(poliza_id, hash_params(params))
+            data_hash = hash_training_data(df_features)
+            last_date = pd.Timestamp(df_features["FECHA"].max())
+
+            stored = self._load(key, poliza_id)
+            if stored is not None and self._is_fresh(stored[1], data_hash, last_date):
+                self._touch(key)
+                return stored[0]
+
+            if stored is not None and self.update_rounds and stored[1].get("n_updates", 0) < self.max_updates:
+                model = self.update_model(poliza_id, df_features, params)
+                if model is not None:
+                    return model
+
+            model = train_consumption_model(df_features, params)
+            self._save(key, model, self._metadata(poliza_id, df_features, params=params))
+            return model
+
+    def get_horizon_model(self, poliza_id, df_features, forecast_days=30, quantiles=False, params=None):
+        """
+        Returns the direct multi-horizon model of `poliza_id` (or, with
+        `quantiles`, its multi-quantile band model) for `forecast_days`,
+        loaded from the store while it is fresh for `df_features` and fully
+        retrained (and saved) otherwise.
+
+        These models are stored next to the recursive ones, keyed by their
+        hyperparameters, kind and horizon.
+
+        Args:
+            poliza_id (str): POLIZA_SUMINISTRO the model belongs to.
+            df_features (pandas.DataFrame): Feature-engineered training rows (no NaN).
+            forecast_days (int): Longest horizon the model is trained for.
+            quantiles (bool): Whether to return the quantile model instead of the direct one.
+            params (dict, optional): Hyperparameters, the store's (QUANTILE_PARAMS for
+                the quantile model) if None.
+
+        Returns:
+            xgboost.XGBRegressor: The fitted model.
+        """
+        with self._lock:
+            params = params or (QUANTILE_PARAMS if quantiles else self.params)
+            key_params = dict(params, model_kind="quantile" if quantiles else "direct", forecast_days=forecast_days)
+            key = self._key(poliza_id, hash_params(key_params))
+
+            stored = self._load(key, poliza_id)
+            last_date = pd.Timestamp(df_features["FECHA"].max())
+            if stored is not None and self._is_fresh(stored[1], hash_training_data(df_features), last_date):
+                self._touch(key)
+                return stored[0]
+
+            df_direct = build_direct_features(df_features, forecast_days)
+            model = train_quantile_model(df_direct, params) if quantiles else train_direct_model(df_direct, params)
+            self._save(key, model, self._metadata(poliza_id, df_features, params=key_params))
+            return model
+
+    def clear(self):
+        """
+        Removes every stored model.
+        """
+        with self._lock:
+            for file_name in os.listdir(self.store_dir):
+                if file_name.endswith(".json"):
+                    os.remove(os.path.join(self.store_dir, file_name))
+            self._memory.clear()
+            self._n_models = 0
+
+
+def get_shared_model_store(store_dir=MODELS_DIR):
+    """
+    Process-wide ModelStore of `store_dir`, shared by every page and session
+    so they use the same in-memory models and on-disk model count.
+    """
+    store_dir = os.path.abspath(store_dir)
+    with _lock:
+        if store_dir not in _stores:
+            _stores[store_dir] = ModelStore(store_dir)
+        return _stores[store_dir]
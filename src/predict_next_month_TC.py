@@ -1,78 +1,335 @@
+import numpy as np
 import pandas as pd
 from xgboost import XGBRegressor
 
-def predict_next_month_total_consumption(df_poliza, poliza_id, forecast_days=30):
+FEATURES = ["year", "month", "day", "dayofweek", "lag_1", "lag_7", "rolling_mean_7"]
+TARGET = "CONSUMO_REAL"
+
+# Direct multi-horizon model: the horizon (days ahead) + the target day's
+# calendar + the lag / rolling features of the known history
+DIRECT_FEATURES = ["horizon"] + FEATURES
+FORECAST_MODES = ("recursive", "direct")
+
+# Forecast bands: quantile levels of one multi-quantile fit and their columns
+QUANTILES = [0.1, 0.5, 0.9]
+QUANTILE_COLUMNS = ["P10", "P50", "P90"]
+
+XGB_PARAMS = {
+    "n_estimators": 300,
+    "learning_rate": 0.05,
+    "max_depth": 6,
+    "subsample": 0.8,
+    "colsample_bytree": 0.8,
+    "random_state": 42,
+    "tree_method": "hist",
+}
+
+# The quantile model is fitted on horizon-repeated rows of a single póliza;
+# shallow, regularised trees keep its bands from collapsing on the training data
+QUANTILE_PARAMS = dict(XGB_PARAMS, n_estimators=100, max_depth=3, min_child_weight=20)
+
+
+def add_temporal_features(df):
+    """
+    Adds the calendar features (year, month, day, dayofweek) derived from FECHA.
+    """
+    df["year"] = df["FECHA"].dt.year
+    df["month"] = df["FECHA"].dt.month
+    df["day"] = df["FECHA"].dt.day
+    df["dayofweek"] = df["FECHA"].dt.dayofweek
+    return df
+
+
+def train_consumption_model(df_features, params=None):
+    """
+    Fits the XGBoost regressor on an already feature-engineered DataFrame.
+    `params` overrides the default XGB_PARAMS.
+    """
+    model = XGBRegressor(**(params or XGB_PARAMS))
+    model.fit(df_features[FEATURES], df_features[TARGET])
+    return model
+
+
+def recent_window(values, window=7):
+    """
+    Returns the last `window` values of a series as a float array, left-padded
+    with NaN when less history is available.
+    """
+    recent = np.full(window, np.nan)
+    values = np.asarray(values, dtype=float)[-window:]
+    if len(values):
+        recent[-len(values):] = values
+    return recent
+
+
+def recursive_forecast_batch(model, last_dates, recent_values, forecast_days=30):
+    """
+    Recursive forecast for many series at once, using one batched
+    `model.predict` call per horizon day.
+
+    The last 7 known values of every series are kept in a preallocated ring
+    buffer; each prediction overwrites the oldest slot, so lag_1, lag_7 and
+    rolling_mean_7 are read straight from the buffer without copying history.
+
+    Args:
+        model: Fitted regressor trained on FEATURES.
+        last_dates (array-like): Last known FECHA of each series, shape (n,).
+        recent_values (numpy.ndarray): Last 7 known consumptions of each series in
+            chronological order, shape (n, 7), NaN-padded on the left (see `recent_window`).
+        forecast_days (int): Number of days to forecast.
+
+    Returns:
+        numpy.ndarray: Predicted consumption, shape (n, forecast_days).
+    """
+    last_dates = pd.DatetimeIndex(last_dates)
+    buffer = np.array(recent_values, dtype=float, copy=True).reshape(len(last_dates), 7)
+    n_known = np.minimum((~np.isnan(buffer)).sum(axis=1), 7)
+    head = 0  # slot holding the oldest value
+    predictions = np.empty((len(last_dates), forecast_days))
+
+    for i in range(1, forecast_days + 1):
+        next_dates = last_dates + pd.Timedelta(days=i)
+        window = buffer[:, (head + np.arange(7)) % 7]
+
+        X_future = pd.DataFrame({
+            "year": next_dates.year.astype("int64"),
+            "month": next_dates.month.astype("int64"),
+            "day": next_dates.day.astype("int64"),
+            "dayofweek": next_dates.dayofweek.astype("int64"),
+            "lag_1": window[:, -1],
+            "lag_7": np.where(n_known >= 7, window[:, 0], window[:, -1]),
+            "rolling_mean_7": np.nansum(window, axis=1) / n_known,
+        })[FEATURES]
+        next_consumption = model.predict(X_future).astype(float)
+        predictions[:, i - 1] = next_consumption
+
+        # Add predicted value to the buffer for recursive feature updates
+        buffer[:, head] = next_consumption
+        head = (head + 1) % 7
+        n_known = np.minimum(n_known + 1, 7)
+
+    return predictions
+
+
+def recursive_forecast(model, history, poliza_id, forecast_days=30):
+    """
+    Forecasts `forecast_days` days ahead for one póliza, feeding every prediction
+    back as the lag / rolling features of the next day.
+    """
+    last_date = history["FECHA"].iloc[-1]
+    predictions = recursive_forecast_batch(
+        model, [last_date], recent_window(history["CONSUMO_REAL"])[None, :], forecast_days
+    )[0]
+    return _forecast_frame(poliza_id, last_date, predictions)
+
+
+def _forecast_frame(poliza_id, last_date, predictions):
+    dates = pd.DatetimeIndex([last_date + pd.Timedelta(days=i) for i in range(1, len(predictions) + 1)])
+    forecast_df = pd.DataFrame({
+        "POLIZA_SUMINISTRO": poliza_id,
+        "FECHA": dates,
+        "CONSUMO_REAL": predictions,
+        "year": dates.year.astype("int64"),
+        "month": dates.month.astype("int64"),
+        "day": dates.day.astype("int64"),
+        "dayofweek": dates.dayofweek.astype("int64"),
+        "is_forecast": True
+    })
+    return forecast_df
+
+
+def _origin_features(windows):
+    # lag / rolling features of the day after the window, as in the recursive mode
+    n_known = np.minimum((~np.isnan(windows)).sum(axis=1), 7)
+    return {
+        "lag_1": windows[:, -1],
+        "lag_7": np.where(n_known >= 7, windows[:, 0], windows[:, -1]),
+        "rolling_mean_7": np.nansum(windows, axis=1) / n_known,
+    }
+
+
+def _direct_rows(origin_features, last_dates, forecast_days):
+    # one row per (series, horizon): origin features + calendar of the target day
+    n = len(last_dates)
+    horizon = np.tile(np.arange(1, forecast_days + 1), n)
+    target_dates = pd.DatetimeIndex(np.repeat(np.asarray(last_dates, dtype="datetime64[ns]"), forecast_days)
+                                    + pd.to_timedelta(horizon, unit="D"))
+    rows = pd.DataFrame({
+        "horizon": horizon,
+        "year": target_dates.year.astype("int64"),
+        "month": target_dates.month.astype("int64"),
+        "day": target_dates.day.astype("int64"),
+        "dayofweek": target_dates.dayofweek.astype("int64"),
+    })
+    for name, values in origin_features.items():
+        rows[name] = np.repeat(np.asarray(values, dtype=float), forecast_days)
+    return rows[DIRECT_FEATURES], target_dates
+
+
+def build_direct_features(df_features, forecast_days=30):
+    """
+    Horizon-indexed training rows for the direct multi-horizon model of one póliza.
+
+    Every feature row (whose lag / rolling features describe the history up
+    to the day before it) is repeated for horizons 1..`forecast_days`, with
+    the calendar features and the target of the day `horizon` days after
+    that history ends. Rows whose target day has no reading are dropped.
+
+    Args:
+        df_features (pandas.DataFrame): Feature rows of one póliza sorted by FECHA (no NaN).
+        forecast_days (int): Longest horizon to train for.
+
+    Returns:
+        pandas.DataFrame: DIRECT_FEATURES and TARGET.
+    """
+    origins = {name: df_features[name].to_numpy(dtype=float) for name in ["lag_1", "lag_7", "rolling_mean_7"]}
+    history_ends = pd.DatetimeIndex(df_features["FECHA"]) - pd.Timedelta(days=1)
+    rows, target_dates = _direct_rows(origins, history_ends, forecast_days)
+
+    values = df_features.drop_duplicates("FECHA", keep="last").set_index("FECHA")["CONSUMO_REAL"]
+    rows[TARGET] = values.reindex(target_dates).to_numpy()
+    return rows.dropna(subset=[TARGET]).reset_index(drop=True)
+
+
+def train_direct_model(df_direct, params=None):
+    """
+    Fits the direct multi-horizon regressor on rows from `build_direct_features`.
+    """
+    model = XGBRegressor(**(params or XGB_PARAMS))
+    model.fit(df_direct[DIRECT_FEATURES], df_direct[TARGET])
+    return model
+
+
+def direct_forecast_batch(model, last_dates, recent_values, forecast_days=30):
+    """
+    Direct multi-horizon forecast for many series: days 1..`forecast_days`
+    are all predicted from the same known history in one `model.predict`
+    call, with no prediction fed back as a feature.
+
+    Args:
+        model: Fitted regressor trained on DIRECT_FEATURES.
+        last_dates (array-like): Last known FECHA of each series, shape (n,).
+        recent_values (numpy.ndarray): Last 7 known consumptions of each series, shape (n, 7),
+            NaN-padded on the left (see `recent_window`).
+        forecast_days (int): Number of days to forecast.
+
+    Returns:
+        numpy.ndarray: Predicted consumption, shape (n, forecast_days).
+    """
+    windows = np.asarray(recent_values, dtype=float).reshape(-1, 7)
+    rows, _ = _direct_rows(_origin_features(windows), pd.DatetimeIndex(last_dates), forecast_days)
+    return model.predict(rows).astype(float).reshape(len(windows), forecast_days)
+
+
+def direct_forecast(model, history, poliza_id, forecast_days=30):
+    """
+    Forecasts `forecast_days` days ahead for one póliza with the direct model.
+    """
+    last_date = history["FECHA"].iloc[-1]
+    predictions = direct_forecast_batch(
+        model, [last_date], recent_window(history["CONSUMO_REAL"])[None, :], forecast_days
+    )[0]
+    return _forecast_frame(poliza_id, last_date, predictions)
+
+
+def train_quantile_model(df_direct, params=None, quantiles=QUANTILES):
+    """
+    Fits every quantile of `quantiles` in a single XGBoost model with the
+    quantile (pinball) loss, on rows from `build_direct_features`
+    (with QUANTILE_PARAMS unless `params` are given).
+    """
+    quantile_params = dict(params or QUANTILE_PARAMS, objective="reg:quantileerror",
+                           quantile_alpha=np.asarray(quantiles, dtype=float))
+    model = XGBRegressor(**quantile_params)
+    model.fit(df_direct[DIRECT_FEATURES], df_direct[TARGET])
+    return model
+
+
+def quantile_forecast_batch(model, last_dates, recent_values, forecast_days=30):
+    """
+    Daily forecast bands for many series, from one `model.predict` call of a
+    model fitted with `train_quantile_model`.
+
+    Quantiles are sorted per day (independent quantile trees can cross) and
+    floored at 0, as consumption is never negative.
+
+    Returns:
+        numpy.ndarray: Predicted quantiles, shape (n, forecast_days, n_quantiles).
+    """
+    windows = np.asarray(recent_values, dtype=float).reshape(-1, 7)
+    rows, _ = _direct_rows(_origin_features(windows), pd.DatetimeIndex(last_dates), forecast_days)
+    predictions = model.predict(rows).astype(float).reshape(len(windows), forecast_days, -1)
+    return np.maximum(np.sort(predictions, axis=-1), 0)
+
+
+def predict_next_month_total_consumption(df_poliza, poliza_id, forecast_days=30, model_store=None,
+                                         global_model=None, params=None, mode="recursive", quantiles=False):
     """
     Predict total water consumption for the next month (or custom number of days)
     for a given POLIZA_SUMINISTRO and return the historical + forecasted data.
+
+    If a `model_store` (see src.model_store.ModelStore) is given, the model is
+    loaded from it and only retrained when the stored one is stale.
+    If a `global_model` (see src.global_model.GlobalConsumptionModel) knows the
+    póliza, it is used instead of training a per-póliza model.
+    `params` overrides XGB_PARAMS for the per-póliza model (e.g. the settings
+    tuned for its segment, see src.tuning.params_for_poliza).
+
+    `mode` is "recursive" (one prediction per day, fed back as the next
+    day's lags) or "direct" (a per-póliza multi-horizon model predicting all
+    `forecast_days` days in one call, cached in the model store like the
+    recursive ones; the global model is recursive and not used).
+
+    If `quantiles` is True, the P10 / P50 / P90 of every forecast day are
+    added to forecast_df (QUANTILE_COLUMNS) from a single multi-quantile
+    direct model (cached in the model store, if given), and the totals of
+    those bands are returned as a fourth value (a Series indexed by
+    QUANTILE_COLUMNS). The band totals are sums of the daily quantiles, i.e.
+    they assume that the days of the horizon run high or low together.
     """
+    if mode not in FORECAST_MODES:
+        raise ValueError(f"Unknown forecast mode: {mode}")
+    use_global = mode == "recursive" and global_model is not None and global_model.knows(poliza_id)
 
-    # --- Feature engineering ---    
+    # --- Feature engineering ---
     df_poliza["lag_1"] = df_poliza["CONSUMO_REAL"].shift(1)
     df_poliza["lag_7"] = df_poliza["CONSUMO_REAL"].shift(7)
     df_poliza["rolling_mean_7"] = (
         df_poliza["CONSUMO_REAL"].shift(1).rolling(window=7).mean()
     )
-    df_poliza = df_poliza.dropna().reset_index(drop=True)
-    
+    if use_global:
+        # the global model does not need a full 7-day history to train on
+        df_poliza = df_poliza.dropna(subset=["CONSUMO_REAL"]).reset_index(drop=True)
+    else:
+        df_poliza = df_poliza.dropna().reset_index(drop=True)
+
     # --- Model training ---
-    features = ["year", "month", "day", "dayofweek", "lag_1", "lag_7", "rolling_mean_7"]
-    target = "CONSUMO_REAL"
-    
-    X = df_poliza[features]
-    y = df_poliza[target]
-    
-    model = XGBRegressor(
-        n_estimators=300,
-        learning_rate=0.05,
-        max_depth=6,
-        subsample=0.8,
-        colsample_bytree=0.8,
-        random_state=42,
-        tree_method="hist"
-    )
-    model.fit(X, y)
-    
+    if mode == "direct" and model_store is not None:
+        model = model_store.get_horizon_model(poliza_id, df_poliza, forecast_days, params=params)
+    elif mode == "direct":
+        model = train_direct_model(build_direct_features(df_poliza, forecast_days), params)
+    elif use_global:
+        model = global_model.bind([poliza_id])
+    elif model_store is not None:
+        model = model_store.get_model(poliza_id, df_poliza, params)
+    else:
+        model = train_consumption_model(df_poliza, params)
+
     # --- Forecasting ---
-    last_known = df_poliza.iloc[-1].copy()
-    forecast = []
-    history = df_poliza.copy()
+    forecast = direct_forecast if mode == "direct" else recursive_forecast
+    forecast_df = forecast(model, df_poliza.copy(), poliza_id, forecast_days)
+
+    if quantiles:
+        if model_store is not None:
+            quantile_model = model_store.get_horizon_model(poliza_id, df_poliza, forecast_days, quantiles=True)
+        else:
+            quantile_model = train_quantile_model(build_direct_features(df_poliza, forecast_days))
+        bands = quantile_forecast_batch(
+            quantile_model, [df_poliza["FECHA"].iloc[-1]],
+            recent_window(df_poliza["CONSUMO_REAL"])[None, :], forecast_days,
+        )[0]
+        forecast_df[QUANTILE_COLUMNS] = bands
 
-    for i in range(1, forecast_days + 1):
-        next_date = last_known["FECHA"] + pd.Timedelta(days=i)
-
-        # compute features dynamically
-        recent_data = history.tail(7)["CONSUMO_REAL"]
-        new_data = {
-            "year": next_date.year,
-            "month": next_date.month,
-            "day": next_date.day,
-            "dayofweek": next_date.dayofweek,
-            "lag_1": history.iloc[-1]["CONSUMO_REAL"],
-            "lag_7": recent_data.iloc[0] if len(recent_data) >= 7 else history.iloc[-1]["CONSUMO_REAL"],
-            "rolling_mean_7": recent_data.mean()
-        }
-
-        X_future = pd.DataFrame([new_data])[features]
-        next_consumption = float(model.predict(X_future)[0])
-
-        new_row = {
-            "POLIZA_SUMINISTRO": poliza_id,
-            "FECHA": next_date,
-            "CONSUMO_REAL": next_consumption,
-            "year": next_date.year,
-            "month": next_date.month,
-            "day": next_date.day,
-            "dayofweek": next_date.dayofweek,
-            "is_forecast": True
-        }
-
-        forecast.append(new_row)
-        # Add predicted value to history for recursive feature updates
-        history = pd.concat([history, pd.DataFrame([new_row])], ignore_index=True)
-
-    forecast_df = pd.DataFrame(forecast)
-    
     # Add flag to original data
     df_poliza["is_forecast"] = False
 
@@ -80,10 +337,14 @@ def predict_next_month_total_consumption(df_poliza, poliza_id, forecast_days=30)
     df_extended = pd.concat([df_poliza, forecast_df], ignore_index=True).sort_values("FECHA")
     total_consumption = forecast_df["CONSUMO_REAL"].sum()
 
+    if quantiles:
+        return total_consumption, forecast_df, df_extended, forecast_df[QUANTILE_COLUMNS].sum()
     return total_consumption, forecast_df, df_extended
 
 
-def call_predict_next_month_total_consumption(df, poliza_id, forecast_days=30): 
+def call_predict_next_month_total_consumption(df, poliza_id, forecast_days=30, model_store=None,
+                                              global_model=None, params=None, mode="recursive",
+                                              quantiles=False):
     """
     Wrapper to filter data by POLIZA_SUMINISTRO and call the prediction function.
     """
@@ -98,21 +359,113 @@ def call_predict_next_month_total_consumption(df, poliza_id, forecast_days=30):
     df_poliza = df_poliza.sort_values(by="FECHA").reset_index(drop=True)
 
     # --- Add temporal features ---
-    df_poliza["year"] = df_poliza["FECHA"].dt.year
-    df_poliza["month"] = df_poliza["FECHA"].dt.month
-    df_poliza["day"] = df_poliza["FECHA"].dt.day
-    df_poliza["dayofweek"] = df_poliza["FECHA"].dt.dayofweek
+    df_poliza = add_temporal_features(df_poliza)
 
-    total_consumption, forecast_df, df_extended = predict_next_month_total_consumption(
-        df_poliza, poliza_id, forecast_days
+    return predict_next_month_total_consumption(
+        df_poliza, poliza_id, forecast_days, model_store, global_model, params, mode, quantiles
     )
 
-    return total_consumption, forecast_df, df_extended
 
+def build_features_all_polizas(df):
+    """
+    Builds the temporal, lag and rolling features for every POLIZA_SUMINISTRO
+    at once, using grouped shifts / rolling windows over a single sort.
 
+    Args:
+        df (pandas.DataFrame): ICI data with POLIZA_SUMINISTRO, FECHA and CONSUMO_REAL.
+
+    Returns:
+        pandas.DataFrame: Rows sorted by (POLIZA_SUMINISTRO, FECHA) with the model features.
+            Rows without a full 7-day history keep NaN features.
+    """
+    df_ = df[["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"]].copy()
+    df_["FECHA"] = pd.to_datetime(df_["FECHA"])
+    df_ = df_.sort_values(["POLIZA_SUMINISTRO", "FECHA"], kind="stable").reset_index(drop=True)
+    df_ = add_temporal_features(df_)
+
+    # --- Grouped feature engineering (one pass for all polizas) ---
+    grouped = df_.groupby("POLIZA_SUMINISTRO", sort=False)["CONSUMO_REAL"]
+    df_["lag_1"] = grouped.shift(1)
+    df_["lag_7"] = grouped.shift(7)
+    df_["rolling_mean_7"] = (
+        df_["lag_1"]
+        .groupby(df_["POLIZA_SUMINISTRO"], sort=False)
+        .rolling(window=7)
+        .mean()
+        .reset_index(level=0, drop=True)
+    )
+    return df_
 
 
+def recent_windows_all_polizas(df_features, window=7):
+    """
+    Collects the last known FECHA and the last `window` consumptions of every
+    póliza in one grouped pass.
 
+    Args:
+        df_features (pandas.DataFrame): Rows sorted by (POLIZA_SUMINISTRO, FECHA)
+            without missing CONSUMO_REAL, e.g. from `build_features_all_polizas`.
+        window (int): Number of recent values to keep.
+
+    Returns:
+        tuple: (poliza_ids, last_dates, windows) where windows has shape
+            (n_polizas, window) and is NaN-padded on the left like `recent_window`.
+    """
+    tail = df_features.groupby("POLIZA_SUMINISTRO", sort=False).tail(window)
+    grouped = tail.groupby("POLIZA_SUMINISTRO", sort=False)
+
+    poliza_ids = grouped.size().index.to_numpy()
+    rows = grouped.ngroup().to_numpy()
+    slots = window - 1 - grouped.cumcount(ascending=False).to_numpy()
+
+    windows = np.full((len(poliza_ids), window), np.nan)
+    windows[rows, slots] = tail["CONSUMO_REAL"].to_numpy(dtype=float)
+    last_dates = pd.DatetimeIndex(grouped["FECHA"].last().to_numpy())
+    return poliza_ids, last_dates, windows
+
+
+def predict_all_polizas(df, forecast_days=30, model_store=None, global_model=None):
+    """
+    Forecasts the next `forecast_days` days of consumption for every
+    POLIZA_SUMINISTRO in `df` in a single run.
+
+    Features are built once for the whole dataset and the data is split by
+    póliza with one groupby, instead of masking the full DataFrame per póliza.
+    Pólisses without enough history to train a model are skipped.
+
+    With a `global_model`, every póliza it knows is forecast in one batched
+    recursive run; the remaining ones fall back to per-póliza models.
+
+    Args:
+        df (pandas.DataFrame): ICI data with POLIZA_SUMINISTRO, FECHA and CONSUMO_REAL.
+        forecast_days (int): Number of days to forecast.
+        model_store (ModelStore): Optional store to reuse fresh models from.
+        global_model (GlobalConsumptionModel): Optional cross-póliza model.
+
+    Returns:
+        pandas.DataFrame: Tidy table with one row per (POLIZA_SUMINISTRO, FECHA)
+            forecasted day and its predicted CONSUMO_REAL.
+    """
+    df_features = build_features_all_polizas(df)
 
+    forecasts = []
+    if global_model is not None:
+        global_forecast = global_model.forecast(df_features, forecast_days)
+        forecasts.append(global_forecast)
+        # pólisses unknown to the global model fall back to their own model
+        known = df_features["POLIZA_SUMINISTRO"].isin(global_forecast["POLIZA_SUMINISTRO"])
+        df_features = df_features[~known]
 
+    df_features = df_features.dropna(subset=FEATURES + [TARGET])
+    for poliza_id, df_poliza in df_features.groupby("POLIZA_SUMINISTRO", sort=False):
+        df_poliza = df_poliza.reset_index(drop=True)
+        if model_store is not None:
+            model = model_store.get_model(poliza_id, df_poliza)
+        else:
+            model = train_consumption_model(df_poliza)
+        forecasts.append(recursive_forecast(model, df_poliza, poliza_id, forecast_days))
 
+    columns = ["POLIZA_SUMINISTRO", "FECHA", "CONSUMO_REAL"]
+    if not forecasts:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(forecasts, ignore_index=True)[columns]
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+# Matches offered to a search box at most
+MAX_MATCHES = 50
+
+
+class PrefixIndex:
+    """
+    Sorted key index answering prefix queries by binary search.
+
+    The distinct keys (e.g. every POLIZA_SUMINISTRO or SECCIO_CENSAL code)
+    are sorted once; all keys starting with a prefix form a contiguous slice
+    of the sorted array, whose bounds are found with two searchsorted calls.
+    A query costs O(log n) whatever the number of keys, and only the first
+    `top_n` matches are materialized.
+
+    Args:
+        keys (array-like): Keys to index, duplicates and missing values are dropped.
+    """
+
+    def __init__(self, keys):
+        keys = pd.Series(keys).dropna()
+        if isinstance(keys.dtype, pd.CategoricalDtype):
+            # only the categories that are actually used
+            keys = keys.cat.remove_unused_categories().cat.categories.to_series()
+        # deduplicate with a hash table first, only the distinct keys are sorted
+        self.keys = np.sort(pd.unique(keys.to_numpy()).astype(str))
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _bounds(self, prefix):
+        low = np.searchsorted(self.keys, prefix, side="left")
+        # every key starting with `prefix` sorts below prefix + the highest code point
+        high = np.searchsorted(self.keys, prefix + "\U0010ffff", side="left")
+        return low, high
+
+    def count(self, prefix=""):
+        """
+        Number of keys starting with `prefix`.
+        """
+        low, high = self._bounds(str(prefix))
+        return int(high - low)
+
+    def search(self, prefix="", top_n=MAX_MATCHES):
+        """
+        The first `top_n` keys (in sorted order) starting with `prefix`,
+        all keys' first `top_n` for an empty prefix.
+
+        Returns:
+            list: Matching keys.
+        """
+        low, high = self._bounds(str(prefix))
+        if top_n is not None:
+            high = min(high, low + top_n)
+        return self.keys[low:high].tolist()
@@ -0,0 +1,170 @@
+import json
+import os
+
+import numpy as np
+import xgboost as xgb
+
+from src.global_model import static_attributes
+from src.predict_next_month_TC import FEATURES, TARGET, XGB_PARAMS, build_features_all_polizas
+
+# Pólisses are tuned in segments of use type and meter model
+SEGMENT_COLUMNS = ["US_AIGUA_GEST", "CODI_MODEL"]
+ALL_SEGMENTS = "__all__"
+
+SEARCH_SPACE = {
+    "max_depth": [3, 4, 6, 8],
+    "learning_rate": [0.03, 0.05, 0.1],
+    "subsample": [0.8, 1.0],
+    "colsample_bytree": [0.8, 1.0],
+    "min_child_weight": [1, 5],
+}
+
+
+def segment_key(values):
+    return "|".join(str(v) for v in values)
+
+
+def time_split(df_features, valid_fraction=0.2):
+    """
+    Time-ordered split: the last `valid_fraction` of the dates is kept for
+    validation, so the model is always validated on readings after the ones
+    it was trained on.
+    """
+    dates = np.sort(df_features["FECHA"].unique())
+    split_date = dates[int(len(dates) * (1 - valid_fraction))]
+    return df_features[df_features["FECHA"] < split_date], df_features[df_features["FECHA"] >= split_date]
+
+
+def _booster_params(params):
+    # XGBRegressor settings -> xgb.train parameters
+    booster_params = {k: v for k, v in params.items() if k not in ("n_estimators", "random_state")}
+    booster_params["seed"] = params.get("random_state", 0)
+    booster_params.setdefault("objective", "reg:squarederror")
+    booster_params["eval_metric"] = "rmse"
+    return booster_params
+
+
+def sample_trials(search_space=SEARCH_SPACE, n_trials=20, random_state=42):
+    """
+    Draws `n_trials` distinct settings from the grid in `search_space`
+    (the whole grid if it is smaller).
+    """
+    names = list(search_space)
+    grid = np.array(np.meshgrid(*[np.arange(len(search_space[n])) for n in names])).reshape(len(names), -1).T
+    rng = np.random.default_rng(random_state)
+    picked = grid[rng.permutation(len(grid))[:n_trials]]
+    return [{name: search_space[name][i] for name, i in zip(names, row)} for row in picked]
+
+
+def tune_segment(df_features, n_trials=20, max_rounds=1000, early_stopping_rounds=30, valid_fraction=0.2,
+                 search_space=SEARCH_SPACE, max_bin=256, random_state=42):
+    """
+    Tunes the forecaster on the pooled feature rows of one segment.
+
+    The training and validation rows are quantized once into QuantileDMatrix
+    objects (the validation one reuses the training bin cuts) that every
+    trial shares, and every trial stops adding trees when the validation
+    RMSE has not improved for `early_stopping_rounds` rounds. The default
+    XGB_PARAMS are scored on the same split for comparison.
+
+    Args:
+        df_features (pandas.DataFrame): Feature rows without NaN (FEATURES, TARGET, FECHA).
+        n_trials (int): Settings drawn from `search_space`.
+        max_rounds (int): Maximum trees per trial.
+        early_stopping_rounds (int): Rounds without improvement before stopping.
+        valid_fraction (float): Share of the latest dates used for validation.
+        search_space (dict): Candidate values of every hyperparameter.
+        max_bin (int): Histogram bins of the quantized matrices.
+        random_state (int): Seed of the trial sampling and of XGBoost.
+
+    Returns:
+        dict: The best settings as XGBRegressor parameters (n_estimators = best number
+            of trees), with their valid_rmse, the baseline_rmse of XGB_PARAMS and n_rows.
+    """
+    train, valid = time_split(df_features, valid_fraction)
+    dtrain = xgb.QuantileDMatrix(train[FEATURES], train[TARGET], max_bin=max_bin)
+    dvalid = xgb.QuantileDMatrix(valid[FEATURES], valid[TARGET], ref=dtrain)
+
+    base = {"tree_method": "hist", "random_state": random_state, "max_bin": max_bin}
+    best = None
+    for trial in sample_trials(search_space, n_trials, random_state):
+        params = dict(base, **trial)
+        booster = xgb.train(
+            _booster_params(params), dtrain, num_boost_round=max_rounds, evals=[(dvalid, "valid")],
+            early_stopping_rounds=early_stopping_rounds, verbose_eval=False,
+        )
+        if best is None or booster.best_score < best["valid_rmse"]:
+            best = dict(params, n_estimators=booster.best_iteration + 1, valid_rmse=booster.best_score)
+
+    baseline = xgb.train(
+        _booster_params(dict(XGB_PARAMS, max_bin=max_bin)), dtrain, num_boost_round=XGB_PARAMS["n_estimators"],
+        evals=[(dvalid, "valid")], verbose_eval=False,
+    )
+    best["baseline_rmse"] = float(baseline.eval(dvalid).split(":")[-1])
+    best["n_rows"] = int(len(df_features))
+    return best
+
+
+def tune_all_segments(df, min_rows=5000, **tune_kwargs):
+    """
+    Tunes one set of hyperparameters per segment (SEGMENT_COLUMNS) and one for
+    all the data together, used for segments too small to tune.
+
+    Args:
+        df (pandas.DataFrame): ICI data with POLIZA_SUMINISTRO, FECHA, CONSUMO_REAL and
+            the SEGMENT_COLUMNS.
+        min_rows (int): Minimum feature rows for a segment to be tuned on its own.
+        **tune_kwargs: Passed to `tune_segment`.
+
+    Returns:
+        dict: Tuned settings per segment key (see `segment_key`) and ALL_SEGMENTS.
+    """
+    segments = static_attributes(df)[SEGMENT_COLUMNS].astype(str).apply(tuple, axis=1).map(segment_key)
+    df_features = build_features_all_polizas(df).dropna(subset=FEATURES + [TARGET])
+    df_features = df_features.assign(segment=df_features["POLIZA_SUMINISTRO"].map(segments).to_numpy())
+
+    tuned = {ALL_SEGMENTS: tune_segment(df_features, **tune_kwargs)}
+    for key, df_segment in df_features.groupby("segment", sort=True):
+        if len(df_segment) >= min_rows:
+            tuned[key] = tune_segment(df_segment, **tune_kwargs)
+    return tuned
+
+
+def save_tuned_params(tuned, path):
+    """
+    Saves the tuned settings of every segment to a JSON file.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump({"segment_columns": SEGMENT_COLUMNS, "segments": tuned}, f, indent=2, default=float)
+
+
+def load_tuned_params(path):
+    """
+    Loads the tuned settings saved with `save_tuned_params` ({} if there are none).
+    """
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)["segments"]
+
+
+def params_for_segment(tuned, segment_values):
+    """
+    XGBRegressor parameters for a segment: its own tuned settings, the ones
+    tuned on all the data if it was not tuned, or XGB_PARAMS if nothing was.
+    """
+    entry = tuned.get(segment_key(segment_values)) or tuned.get(ALL_SEGMENTS)
+    if entry is None:
+        return dict(XGB_PARAMS)
+    return {k: v for k, v in entry.items() if k not in ("valid_rmse", "baseline_rmse", "n_rows")}
+
+
+def params_for_poliza(tuned, df, poliza_id):
+    """
+    Tuned XGBRegressor parameters for `poliza_id`, from its segment in `df`.
+    """
+    statics = df.loc[df["POLIZA_SUMINISTRO"] == poliza_id, SEGMENT_COLUMNS].dropna()
+    if statics.empty:
+        return params_for_segment(tuned, ())
+    return params_for_segment(tuned, statics.iloc[-1].astype(str).tolist())